@@ -0,0 +1,1328 @@
+"""
+Celantur Cloud API v2 client library: the asyncio engine, its building blocks and `CelanturCloudClient`
+for applications. `cloud-api-v2-client.py` is the command line client built on it.
+"""
+
+import requests
+from urllib3.util.retry import Retry
+import time
+import json
+import threading
+import logging
+import os
+import asyncio
+import heapq
+import contextlib
+import uuid
+import sqlite3
+import concurrent.futures
+import collections
+import hashlib
+import shutil
+import bisect
+
+try:
+    import aiohttp
+except ImportError:  # Only required for the asyncio engine and `CelanturCloudClient`
+    aiohttp = None
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:  # Only required for NumPy array inputs of `CelanturCloudClient`
+    np = None
+    cv2 = None
+
+
+TOKEN_RENEWAL_MARGIN = 300.0 # seconds before token expiration to renew it
+SLEEP_TIME = 10.0 # seconds wait time between querying request
+MAX_CHECK_STATUS = 1000 # Retry 1000 times to check status before stopping
+HTTP_RETRIES = 3 # Retries of failed requests
+HTTP_BACKOFF_FACTOR = 0.5 # Backoff between retries: {backoff factor} * 2 ** {retry number} seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5 # Attempts to process a file before giving up
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # bytes written to disk at once while downloading
+STAGE_END = None  # Sentinel closing a pipeline stage queue
+
+# Handlers are only set up when run as a script, applications embedding `CelanturCloudClient` configure logging themselves
+logger = logging.getLogger('my_logger')
+
+
+class Metrics:
+    """
+    Thread-safe latency histograms per processing stage and event counters of a run.
+
+    Stages are timed in seconds into fixed buckets, so quantiles are estimates within the bucket bounds.
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.histograms = {}  # stage -> (bucket counts, [sum, count])
+        self.counters = collections.Counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = ([0] * len(self.BUCKETS), [0.0, 0])
+            buckets, total = self.histograms[stage]
+            buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            total[0] += seconds
+            total[1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """
+        Observe the duration of the block if it does not raise
+        """
+        start = time.monotonic()
+        yield
+        self.observe(stage, time.monotonic() - start)
+
+    def increment(self, counter: str, value: int = 1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def quantile(self, stage: str, q: float) -> float:
+        with self.lock:
+            buckets, (_, count) = self.histograms[stage]
+            buckets = list(buckets)
+        rank = q * count
+        lower = 0.0
+        for upper, bucket_count in zip(self.BUCKETS, buckets):
+            if bucket_count and rank <= bucket_count:
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * rank / bucket_count
+            rank -= bucket_count
+            lower = upper
+        return lower
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: (list(buckets), tuple(total)) for stage, (buckets, total) in self.histograms.items()}
+        totals = {stage: total for stage, (_, total) in histograms.items()}
+        elapsed = time.monotonic() - self.started
+        stages = {stage: {'count': count, 'sum': seconds, 'mean': seconds / count,
+                          'p50': self.quantile(stage, 0.5), 'p90': self.quantile(stage, 0.9), 'p99': self.quantile(stage, 0.99),
+                          'buckets': buckets}
+                  for stage, (buckets, (seconds, count)) in histograms.items()}
+        snapshot = {'timestamp': time.time(), 'elapsed_seconds': elapsed, 'counters': counters, 'stages': stages,
+                    'images_per_second': counters.get('completed', 0) / elapsed if elapsed else 0.0}
+        if totals.get('upload', (0.0,))[0] > 0:
+            snapshot['upload_bytes_per_second'] = counters.get('upload_bytes', 0) / totals['upload'][0]
+        return snapshot
+
+    def load(self, snapshots: [dict]):
+        """
+        Replace the metrics by the sum of snapshots, e.g. of several processes
+        """
+        histograms = {}
+        counters = collections.Counter()
+        for snapshot in snapshots:
+            counters.update(snapshot['counters'])
+            for stage, stats in snapshot['stages'].items():
+                buckets, total = histograms.setdefault(stage, ([0] * len(self.BUCKETS), [0.0, 0]))
+                for i, bucket_count in enumerate(stats['buckets']):
+                    buckets[i] += bucket_count
+                total[0] += stats['sum']
+                total[1] += stats['count']
+        with self.lock:
+            self.histograms = histograms
+            self.counters = counters
+
+    def prometheus(self) -> str:
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: (list(buckets), tuple(total)) for stage, (buckets, total) in self.histograms.items()}
+        lines = ['# HELP celantur_stage_duration_seconds Duration of the processing stages',
+                 '# TYPE celantur_stage_duration_seconds histogram']
+        for stage, (buckets, (seconds, count)) in sorted(histograms.items()):
+            cumulative = 0
+            for upper, bucket_count in zip(self.BUCKETS, buckets):
+                cumulative += bucket_count
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append(f'celantur_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'celantur_stage_duration_seconds_sum{{stage="{stage}"}} {seconds}')
+            lines.append(f'celantur_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        for counter, value in sorted(counters.items()):
+            lines.append(f'# TYPE celantur_{counter}_total counter')
+            lines.append(f'celantur_{counter}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        snapshot = self.snapshot()
+        for stage, stats in sorted(snapshot['stages'].items()):
+            logger.info(f"Stage {stage}: {stats['count']} times, mean {stats['mean']:.3f}s, "
+                        f"p50 {stats['p50']:.3f}s, p99 {stats['p99']:.3f}s")
+        logger.info(f"Counters: {snapshot['counters']}, {snapshot['images_per_second']:.2f} images/s")
+
+
+METRICS = Metrics()
+
+
+class SqliteStore:
+    """
+    SQLite database shared by all threads. Changes are committed in groups by a background thread,
+    so a crash loses at most the changes of the last `commit_interval` seconds, except for changes
+    written with `commit=True`.
+    """
+    def __init__(self, path: str, schema: [str], commit_interval: float = 1.0):
+        self.commit_interval = commit_interval
+        self.changed = False
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self.committer = threading.Thread(name="SqliteCommit", target=self.commit_periodically, daemon=True)
+        self.committer.start()
+
+    def query(self, sql: str, parameters=()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def write(self, sql: str, parameters=(), many: bool = False, commit: bool = False):
+        with self.lock:
+            if many:
+                self.connection.executemany(sql, parameters)
+            else:
+                self.connection.execute(sql, parameters)
+            if commit:
+                self.connection.commit()
+                self.changed = False
+            else:
+                self.changed = True
+
+    def commit_periodically(self):
+        while not self.closed.wait(self.commit_interval):
+            with self.lock:
+                if self.changed:
+                    self.connection.commit()
+                    self.changed = False
+
+    def close(self):
+        self.closed.set()
+        self.committer.join()
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class TaskJournal:
+    """
+    Durable journal of input file -> task ID -> state in a SQLite database.
+
+    Tasks which were uploaded but not downloaded when the client stopped are resumed on the next run:
+    they are only polled and downloaded instead of being created and uploaded again. Therefore uploaded
+    tasks are committed right away instead of with the next group of changes.
+    Without a path the journal records nothing.
+    """
+    CREATED = 'created'
+    UPLOADED = 'uploaded'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path: str = None):
+        self.store = None
+        if path is not None:
+            self.store = SqliteStore(path, [
+                'CREATE TABLE IF NOT EXISTS tasks (file_path TEXT PRIMARY KEY, task_id TEXT, state TEXT NOT NULL, updated REAL)',
+                # Partial index: resuming only reads the few pending tasks, however many entries the journal has
+                f"CREATE INDEX IF NOT EXISTS pending_tasks ON tasks (state) WHERE state = '{self.UPLOADED}'",
+            ])
+
+    def record(self, file_path: str, task_id: str, state: str):
+        if self.store is not None:
+            self.store.write('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)', (file_path, task_id, state, time.time()),
+                             commit=state == self.UPLOADED)
+
+    def pending(self) -> dict:
+        """
+        Relative file path -> task ID of all uploaded but not downloaded tasks
+        """
+        if self.store is None:
+            return {}
+        return dict(self.store.query('SELECT file_path, task_id FROM tasks WHERE state = ?', (self.UPLOADED,)))
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+class ScanIndex:
+    """
+    Persistent index of the input tree for fast incremental rescans.
+
+    The index stores the modification time of every directory and size, modification time and completion
+    state of every file. On a rescan, directories with an unchanged modification time are not listed again
+    and completed files are skipped without checking the output folder. Directories are scanned in parallel.
+    Note that a file modified in place does not change the modification time of its directory.
+    """
+    def __init__(self, path: str, scan_threads: int = 8):
+        self.scan_threads = scan_threads
+        self.store = SqliteStore(path, [
+            'CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirectories TEXT)',
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, '
+            'size INTEGER, mtime_ns INTEGER, done INTEGER NOT NULL DEFAULT 0)',
+            'CREATE INDEX IF NOT EXISTS files_directory ON files (directory)',
+        ])
+
+    def mark_done(self, relative_file_path: str):
+        self.store.write('UPDATE files SET done = 1 WHERE path = ?', (relative_file_path,))
+
+    def close(self):
+        self.store.close()
+
+    @staticmethod
+    def list_directory(root_path: str, relative_path: str, known_mtime_ns: int):
+        """
+        List a directory unless its modification time is unchanged. Runs in the scan threads.
+        """
+        path = os.path.join(root_path, relative_path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        if mtime_ns == known_mtime_ns:
+            return (relative_path, mtime_ns, None, None)
+
+        files, subdirectories = [], []
+        for entry in os.scandir(path):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((os.path.join(relative_path, entry.name), stat.st_size, stat.st_mtime_ns))
+            elif entry.is_dir():
+                subdirectories.append(os.path.join(relative_path, entry.name))
+        return (relative_path, mtime_ns, files, subdirectories)
+
+    def update_directory(self, relative_path: str, mtime_ns: int, files: list, subdirectories: list):
+        # Keep the completion state of files whose size and modification time did not change
+        known = {path: (size, mtime, done) for path, size, mtime, done in
+                 self.store.query('SELECT path, size, mtime_ns, done FROM files WHERE directory = ?', (relative_path,))}
+        rows = [(path, relative_path, size, mtime, int(known.get(path) == (size, mtime, 1)))
+                for path, size, mtime in files]
+        self.store.write('DELETE FROM files WHERE directory = ?', (relative_path,))
+        self.store.write('INSERT INTO files VALUES (?, ?, ?, ?, ?)', rows, many=True)
+        self.store.write('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                         (relative_path, mtime_ns, json.dumps(subdirectories)))
+
+    def scan(self, root_path: str, extensions: [str], recursive: bool):
+        """
+        Yield the relative paths of all input files which are not completed yet
+        """
+        directories = {path: (mtime_ns, json.loads(subdirectories)) for path, mtime_ns, subdirectories in
+                       self.store.query('SELECT path, mtime_ns, subdirectories FROM directories')}
+
+        with concurrent.futures.ThreadPoolExecutor(self.scan_threads, thread_name_prefix='Scan') as executor:
+            def submit(relative_path: str):
+                known_mtime_ns = directories.get(relative_path, (None, None))[0]
+                return executor.submit(self.list_directory, root_path, relative_path, known_mtime_ns)
+
+            pending = {submit("")}
+            while pending:
+                finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        relative_path, mtime_ns, files, subdirectories = future.result()
+                    except OSError as e:
+                        logger.error(e)
+                        continue
+
+                    if files is None:  # Unchanged directory
+                        subdirectories = directories[relative_path][1]
+                    else:
+                        logger.debug(f"Index directory {relative_path or root_path} with {len(files)} files.")
+                        self.update_directory(relative_path, mtime_ns, files, subdirectories)
+                    candidates = self.store.query('SELECT path FROM files WHERE directory = ? AND done = 0', (relative_path,))
+
+                    if recursive:
+                        pending.update(submit(subdirectory) for subdirectory in subdirectories)
+                    for (file_path,) in candidates:
+                        if os.path.splitext(file_path)[1].lower() in extensions:
+                            yield file_path
+
+
+class ResultCache:
+    """
+    Content-addressed cache of anonymized results on local disk.
+
+    Results are stored under the SHA-256 hash of the input file and the anonymisation configuration,
+    so byte-identical inputs are anonymized only once. The least recently used results are evicted
+    once the cache grows beyond `max_size` bytes.
+
+    Identical inputs processed at the same time are anonymized only once as well: the first caller to `claim`
+    a key that is not cached produces its result, the others wait for the returned future until it is stored
+    or the producer gives up with `release`.
+    """
+    def __init__(self, folder: str, max_size: int, anonymisation_configuration: dict):
+        self.folder = folder
+        self.max_size = max_size
+        self.configuration = json.dumps(anonymisation_configuration, sort_keys=True).encode()
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> size, least recently used first
+        self.size = 0
+        self.producing = {}  # key -> Future resolved once the result is stored or released
+
+        os.makedirs(folder, exist_ok=True)
+        cached = []
+        for directory, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                if file_name.endswith('.part'):
+                    # Left over by an interrupted `link_or_copy`
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(directory, file_name))
+                    continue
+                stat = os.stat(os.path.join(directory, file_name))
+                cached.append((stat.st_mtime, file_name, stat.st_size))
+        for _, key, size in sorted(cached):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], key)
+
+    def key(self, file_path: str) -> str:
+        digest = hashlib.sha256(self.configuration)
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def claim(self, key: str) -> concurrent.futures.Future:
+        """
+        Claim producing the result of `key` unless it is cached. Returns None if the result is cached or the caller
+        claimed it, otherwise the future of the caller producing it.
+        """
+        with self.lock:
+            if key in self.entries:
+                return None
+            if key in self.producing:
+                return self.producing[key]
+            self.producing[key] = concurrent.futures.Future()
+            return None
+
+    def release(self, key: str):
+        """
+        Let the callers waiting for the result of `key` go on, after it was stored or could not be produced
+        """
+        with self.lock:
+            producing = self.producing.pop(key, None)
+        if producing is not None:
+            producing.set_result(None)
+
+    def fetch(self, key: str, output_path: str) -> bool:
+        """
+        Hardlink or copy a cached result to `output_path`. Returns False if there is no cached result.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+        cache_path = self.path(key)
+        try:
+            os.utime(cache_path)  # The modification time orders the entries on the next start
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            link_or_copy(cache_path, output_path)
+        except OSError as e:
+            logger.warning(f'Could not use cached result {key}: {e}')
+            return False
+        return True
+
+    def store(self, key: str, result_path: str):
+        cache_path = self.path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        link_or_copy(result_path, cache_path)
+        size = os.path.getsize(cache_path)
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self.release(key)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache fits into `max_size`
+        """
+        evicted = []
+        with self.lock:
+            while self.size > self.max_size and self.entries:
+                key, size = self.entries.popitem(last=False)
+                self.size -= size
+                evicted.append(key)
+        for key in evicted:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(key))
+
+
+def link_or_copy(source: str, destination: str):
+    """
+    Atomically replace `destination` by a hardlink to `source`, or by a copy on another file system
+    """
+    directory, file_name = os.path.split(destination)
+    temporary_path = os.path.join(directory, f'.{file_name}.{uuid.uuid4().hex[:8]}.part')
+    try:
+        try:
+            os.link(source, temporary_path)
+        except OSError:
+            shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_output_file(file_path: str):
+    """
+    Open a temporary file next to `file_path`, which is renamed to `file_path` once it is completely written.
+
+    An interrupted download never leaves a truncated output file that would be skipped on the next run.
+    """
+    directory, file_name = os.path.split(file_path)
+    os.makedirs(directory or '.', exist_ok=True)
+    temporary_path = os.path.join(directory, f'.{file_name}.{uuid.uuid4().hex[:8]}.part')
+    try:
+        with open(temporary_path, 'xb') as f:
+            yield f
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+
+
+def log_pool_statistics(statistics: dict):
+    for host, counts in statistics.items():
+        reused = counts['requests'] - counts['connections']
+        ratio = reused / counts['requests'] if counts['requests'] else 0.0
+        logger.info(f"Connection pool {host}: {counts['requests']} requests over {counts['connections']} connections "
+                    f"({ratio:.0%} reused).")
+
+
+def request_token(session: requests.Session, endpoint_login: str, username: str, password: str) -> (str, float):
+    """
+    Sign in and return the access token with its lifetime in seconds
+    """
+    data = {'username': username, 'password': password}
+    response = session.post(endpoint_login, json=data, headers={'Content-Type':'application/json'})
+    try:
+        resp_dict = response.json()
+        auth_token = resp_dict['AccessToken']
+        expires_in = float(resp_dict.get('ExpiresIn', 3600))
+    except (ValueError, KeyError, TypeError):
+        raise RuntimeError(f'Login error (Status {response.status_code}): {response.text}')
+    logger.info(f'Successfully authenticated and token received (expires in {int(expires_in)} seconds).')
+    return (auth_token, expires_in)
+
+
+class ThrottledError(RuntimeError):
+    """
+    The API rejected a request because of rate limiting or overload (status in RETRY_STATUS_CODES)
+    """
+
+
+def is_unknown_task(task_status) -> bool:
+    """
+    Whether a status request failed because the API does not know the task (anymore),
+    e.g. a task of an old journal, rather than because of authentication or throttling
+    """
+    return isinstance(task_status, int) and 400 <= task_status < 500 and task_status not in (401, 403, 408, 429)
+
+
+class AimdLimit:
+    """
+    Adaptive concurrency limit with additive increase and multiplicative decrease (AIMD).
+
+    Starting from `initial`, the limit grows by one per success (slow start) until the first throttling,
+    afterwards by one per `limit` successes. Successes whose latency exceeds `latency_tolerance` times the
+    lowest latency seen do not increase the limit. Throttling multiplies the limit by `decrease_factor`,
+    at most once per `cooldown` seconds, so one burst of errors does not collapse it.
+    """
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, latency_tolerance: float = 2.0,
+                 decrease_factor: float = 0.5, cooldown: float = 1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.slow_start = True
+        self.min_latency = float('inf')
+        self.last_decrease = float('-inf')
+        self.active = 0
+
+    def success(self, latency: float):
+        self.min_latency = min(self.min_latency, latency)
+        if latency > self.latency_tolerance * self.min_latency:
+            return
+        self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+
+    def throttled(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        logger.warning(f'Throttled by the API, reducing concurrency to {int(self.limit)}.')
+
+
+class AsyncAdaptiveLimiter(AimdLimit):
+    """
+    Concurrency limit adapted to the API's capacity with the interface of asyncio.Semaphore
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = []
+
+    async def acquire(self):
+        while self.active >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def success(self, latency: float):
+        super().success(latency)
+        self.wake()
+
+    def wake(self):
+        # Waiters check the limit again when they resume
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+
+class TokenManager:
+    """
+    Access token shared by all workers and renewed once, shortly before it expires.
+
+    The renewal runs in a background thread, so reading `token` never blocks.
+    """
+    def __init__(self, authenticate, renewal_margin: float = TOKEN_RENEWAL_MARGIN):
+        self.authenticate = authenticate
+        self.renewal_margin = renewal_margin
+        self.token = None
+        self.renew_at = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Authenticate and keep the token fresh in the background
+        """
+        self.renew()
+        self.thread = threading.Thread(name="TokenRenewal", target=self.keep_fresh, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def renew(self):
+        token, expires_in = self.authenticate()
+        # Renew `renewal_margin` seconds before expiration, but not before half of the lifetime has passed
+        self.renew_at = time.monotonic() + max(expires_in - self.renewal_margin, expires_in / 2)
+        self.token = token
+
+    def keep_fresh(self):
+        while not self.stopped.wait(max(self.renew_at - time.monotonic(), 0)):
+            try:
+                self.renew()
+            except (Exception, SystemExit) as e:
+                logger.error(f'Token renewal failed, retrying in {SLEEP_TIME} seconds: {e}')
+                self.renew_at = time.monotonic() + SLEEP_TIME
+
+
+class AsyncHttpClient:
+    """
+    One aiohttp session with keep-alive connection pools per host and retries with exponential backoff
+    """
+    def __init__(self, pool_size: int = 100, retries: int = HTTP_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+        self.statistics = {}
+
+    async def __aenter__(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def _on_request_start(self, session, context, params):
+        context.host = params.url.host
+        self.statistics.setdefault(context.host, {'requests': 0, 'connections': 0})['requests'] += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.statistics[context.host]['connections'] += 1
+
+    def pool_statistics(self) -> dict:
+        """
+        Number of requests and opened connections per host
+        """
+        return self.statistics
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, payload=None, **kwargs):
+        """
+        Send a request, retrying connection errors and the status codes in RETRY_STATUS_CODES.
+        Like urllib3, only idempotent methods are retried.
+
+        Bodies which can only be sent once, like streamed files, are passed as coroutine function `payload`
+        creating the body for each try.
+        """
+        retries = self.retries if method in Retry.DEFAULT_ALLOWED_METHODS else 0
+        for retry in range(retries + 1):
+            last_try = retry == retries
+            try:
+                if payload is not None:
+                    kwargs['data'] = await payload()
+                response = await self.session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectionError:
+                if last_try:
+                    raise
+            else:
+                if response.status not in RETRY_STATUS_CODES or last_try:
+                    break
+                response.release()
+            await asyncio.sleep(self.backoff_factor * 2 ** retry)
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+
+class Job:
+    """
+    One input file travelling through the pipeline stages.
+
+    Instead of a file, the input can be the encoded image `input_data`. Without an output file path,
+    the anonymized image is kept in `output_data`.
+    """
+    def __init__(self, input_file_path: str, output_file_path: str, relative_file_path: str = None, input_data: bytes = None):
+        self.input_file_path = input_file_path
+        self.output_file_path = output_file_path
+        self.relative_file_path = relative_file_path
+        self.input_data = input_data
+        self.output_data = None
+        self.error = None
+        # Set for items submitted to `CelanturCloudClient.submit_many`
+        self.index = None
+        self.item = None
+        self.results = None  # Queue receiving the job when it is finished
+        self.task_id = None
+        self.resumed = False  # Task ID from the journal of an earlier run
+        self.upload_url = None
+        self.state = None
+        self.cache_key = None
+        self.created_at = time.monotonic()
+        self.enqueued_at = None
+        self.uploaded_at = None
+
+
+class StatusTracker:
+    """
+    Central status polling of all uploaded tasks.
+
+    Instead of one sleep loop per task, the tracker owns all pending task IDs and polls the due ones
+    together on a shared schedule. A task is first polled `min_interval` seconds after upload, then
+    with exponentially growing intervals up to `max_interval` for long-running tasks.
+    """
+    def __init__(self, get_task_status, min_interval: float = 1.0, max_interval: float = SLEEP_TIME,
+                 backoff: float = 1.5, poll_concurrency: int = 20, max_checks: int = MAX_CHECK_STATUS):
+        self.get_task_status = get_task_status
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.poll_concurrency = poll_concurrency
+        self.max_checks = max_checks
+        self.pending = []  # Heap of (next poll time, sequence number, number of polls, job)
+        self.sequence = 0
+
+    def interval(self, polls: int) -> float:
+        return min(self.min_interval * self.backoff ** polls, self.max_interval)
+
+    def schedule(self, job, polls: int = 0):
+        next_poll = asyncio.get_running_loop().time() + self.interval(polls)
+        heapq.heappush(self.pending, (next_poll, self.sequence, polls, job))
+        self.sequence += 1
+
+    async def run(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue, finish, recreate=None):
+        """
+        Track all jobs from `in_queue` until the queue is closed. Finished jobs are put into `out_queue`,
+        failed or timed out jobs are passed to the coroutine `finish`.
+
+        Resumed jobs whose task the API does not know anymore are passed to the coroutine `recreate`,
+        which returns True once the job has a new uploaded task to track.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        closed = False
+        recreating = {}  # job -> asyncio task creating and uploading it again
+
+        async def recreate_and_track(job):
+            try:
+                if await recreate(job):
+                    self.schedule(job)
+                else:
+                    await finish(job)
+            finally:
+                del recreating[job]
+                wakeup.set()
+
+        async def receive():
+            nonlocal closed
+            while (job := await in_queue.get()) is not STAGE_END:
+                self.schedule(job)
+                wakeup.set()
+            closed = True
+            wakeup.set()
+
+        receiver = asyncio.create_task(receive())
+        polling = asyncio.Semaphore(self.poll_concurrency)
+
+        async def poll(job):
+            async with polling:
+                try:
+                    return await self.get_task_status(job.task_id)
+                except Exception as e:
+                    logger.error(f'Getting task status of {job.task_id} failed: {e}')
+                    return None
+
+        while not (closed and not self.pending and not recreating):
+            delay = self.pending[0][0] - loop.time() if self.pending else None
+            if delay is None or delay > 0:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = loop.time()
+            due = []
+            while self.pending and self.pending[0][0] <= now:
+                _, _, polls, job = heapq.heappop(self.pending)
+                due.append((polls + 1, job))
+
+            statuses = await asyncio.gather(*(poll(job) for _, job in due))
+            for (polls, job), task_status in zip(due, statuses):
+                if task_status == "done":
+                    if job.uploaded_at is not None:
+                        METRICS.observe('processing', time.monotonic() - job.uploaded_at)
+                    job.enqueued_at = time.monotonic()
+                    await out_queue.put(job)
+                elif task_status == "failed":
+                    logger.error(f"The task {job.task_id} failed.")
+                    job.error = "The task failed"
+                    await finish(job)
+                elif job.resumed and recreate is not None and is_unknown_task(task_status):
+                    recreating[job] = asyncio.create_task(recreate_and_track(job))
+                elif polls >= self.max_checks:
+                    logger.warning(f"The task {job.task_id} did not finish.")
+                    job.error = "The task did not finish"
+                    await finish(job)
+                else:
+                    self.schedule(job, polls)
+
+        await receiver
+        await out_queue.put(STAGE_END)
+
+
+class AsyncEngine:
+    """
+    Process files on a single asyncio event loop with one shared HTTP connection pool.
+
+    The work is split into pipeline stages connected by bounded queues:
+    task creation -> upload -> status tracking -> download.
+    Status tracking is done by one central `StatusTracker` for all tasks.
+    Each stage has its own concurrency limit, so uploads keep streaming while earlier tasks are
+    still processing on the server. The number of jobs in the pipeline adapts to the capacity of the API
+    (see `AimdLimit`), up to `max_in_flight`.
+    """
+    def __init__(self, token_manager: TokenManager, journal: TaskJournal, output_folder: str, anonymisation_configuration: dict, max_in_flight: int,
+                 create_concurrency: int = 10, upload_concurrency: int = 50, download_concurrency: int = 50,
+                 poll_interval_min: float = 1.0, poll_interval_max: float = SLEEP_TIME, scan_index: ScanIndex = None,
+                 result_cache: ResultCache = None, initial_concurrency: int = 10, endpoint_task: str = None,
+                 input_folder: str = None):
+        self.token_manager = token_manager
+        self.endpoint_task = endpoint_task
+        self.journal = journal
+        self.scan_index = scan_index
+        self.result_cache = result_cache
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.anonymisation_configuration = anonymisation_configuration
+        self.max_in_flight = max_in_flight
+        self.initial_concurrency = initial_concurrency
+        self.create_concurrency = create_concurrency
+        self.upload_concurrency = upload_concurrency
+        self.download_concurrency = download_concurrency
+        self.total_count = 0
+        self.http = None
+        self.in_flight = None
+        self.create_queue = None
+        self.status_queue = None
+        self.stages = None
+        self.status_tracker = StatusTracker(self.get_task_status, poll_interval_min, poll_interval_max)
+
+    async def run(self, files, resumed: dict = None):
+        """
+        Process all (input root, relative file path) items of the iterable `files`.
+
+        `resumed` maps relative file paths to IDs of already uploaded tasks, which are only tracked and downloaded.
+        """
+        async with self:
+            await self.feed(files, resumed or {})
+
+    async def __aenter__(self):
+        """
+        Open the connection pool and start the pipeline stages, which then wait for submitted jobs
+        """
+        if aiohttp is None:
+            raise ImportError("The asyncio engine requires aiohttp: pip install aiohttp")
+
+        self.http = AsyncHttpClient(pool_size=self.max_in_flight)
+        await self.http.__aenter__()
+        self.in_flight = AsyncAdaptiveLimiter(self.initial_concurrency, self.max_in_flight)
+
+        self.create_queue = asyncio.Queue(maxsize=self.create_concurrency)
+        upload_queue = asyncio.Queue(maxsize=self.upload_concurrency)
+        self.status_queue = asyncio.Queue(maxsize=self.upload_concurrency)
+        download_queue = asyncio.Queue(maxsize=self.download_concurrency)
+
+        self.stages = asyncio.gather(
+            self.run_stage(self.create_stage, self.create_concurrency, self.create_queue, upload_queue),
+            self.run_stage(self.upload_stage, self.upload_concurrency, upload_queue, self.status_queue),
+            self.status_tracker.run(self.status_queue, download_queue, self.finish, self.recreate),
+            self.run_stage(self.download_stage, self.download_concurrency, download_queue, None),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        """
+        Finish all submitted jobs, then stop the pipeline stages and close the connection pool
+        """
+        try:
+            if exc_type is None:
+                await self.create_queue.put(STAGE_END)
+                await self.stages
+            else:
+                self.stages.cancel()
+                await asyncio.gather(self.stages, return_exceptions=True)
+        finally:
+            await self.http.__aexit__(exc_type, exc, traceback)
+        log_pool_statistics(self.http.pool_statistics())
+
+    async def submit(self, job: Job):
+        """
+        Add a job to the pipeline as soon as the number of jobs in flight allows
+        """
+        wait_start = time.monotonic()
+        await self.in_flight.acquire()
+        METRICS.observe('queue_wait', time.monotonic() - wait_start)
+        job.enqueued_at = time.monotonic()
+        if job.task_id is not None:
+            # Resumed tasks are already uploaded, they skip the creation and upload stages
+            await self.status_queue.put(job)
+        else:
+            await self.create_queue.put(job)
+
+    async def feed(self, files, resumed: dict):
+        for relative_file_path, task_id in resumed.items():
+            input_file_path = None if self.input_folder is None else os.path.join(self.input_folder, relative_file_path)
+            job = Job(input_file_path, os.path.join(self.output_folder, relative_file_path), relative_file_path)
+            job.task_id = task_id
+            job.resumed = True
+            job.state = TaskJournal.UPLOADED
+            logger.info(f"Resume task {task_id} of {relative_file_path}.")
+            await self.submit(job)
+
+        # The file iterator does blocking I/O (scandir, stat), keep it off the event loop
+        file_iterator = iter(files)
+        while (item := await asyncio.to_thread(next, file_iterator, None)) is not None:
+            input_root_path, relative_file_path = item
+            await self.submit(Job(os.path.join(input_root_path, relative_file_path),
+                                  os.path.join(self.output_folder, relative_file_path), relative_file_path))
+
+    def record(self, job: Job, state: str):
+        job.state = state
+        self.journal.record(job.relative_file_path, job.task_id, state)
+
+    async def run_stage(self, handler, concurrency: int, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+        """
+        Run `concurrency` workers applying `handler` to the jobs of `in_queue`.
+
+        Jobs for which the handler returns True are passed on to `out_queue`, all others are finished.
+        """
+        queue_wait = f"queue_wait_{handler.__name__.removesuffix('_stage')}"
+
+        async def worker():
+            while (job := await in_queue.get()) is not STAGE_END:
+                if job.enqueued_at is not None:
+                    METRICS.observe(queue_wait, time.monotonic() - job.enqueued_at)
+                passed = await self.attempt(handler, job)
+                if passed and out_queue is not None:
+                    job.enqueued_at = time.monotonic()
+                    await out_queue.put(job)
+                else:
+                    await self.finish(job)
+            await in_queue.put(STAGE_END)  # Let the sibling workers stop as well
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        if out_queue is not None:
+            await out_queue.put(STAGE_END)
+
+    async def attempt(self, handler, job: Job) -> bool:
+        """
+        Apply `handler` to `job`, retrying failures with backoff instead of dropping the job
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return await handler(job)
+            except Exception as e:
+                if isinstance(e, ThrottledError):
+                    self.in_flight.throttled()
+                    METRICS.increment('throttled')
+                if attempt == MAX_ATTEMPTS:
+                    logger.error(f'Processing {job.relative_file_path} failed: {e}')
+                    job.error = str(e)
+                    return False
+                METRICS.increment('retries')
+                backoff = HTTP_BACKOFF_FACTOR * 2 ** attempt
+                logger.warning(f'Processing {job.relative_file_path} failed (attempt {attempt}/{MAX_ATTEMPTS}), retrying in {backoff} seconds: {e}')
+                await asyncio.sleep(backoff)
+
+    async def recreate(self, job: Job) -> bool:
+        """
+        Create and upload a resumed job again whose task the API does not know anymore
+        """
+        logger.warning(f"Task {job.task_id} of {job.relative_file_path} is unknown to the API, creating a new task.")
+        job.resumed = False
+        if job.input_file_path is None:
+            job.error = f"Task {job.task_id} is unknown to the API"
+            return False
+        return await self.attempt(self.create_stage, job) and await self.attempt(self.upload_stage, job)
+
+    async def finish(self, job: Job):
+        if job.cache_key is not None:
+            self.result_cache.release(job.cache_key)
+        if job.state != TaskJournal.DONE:
+            self.record(job, TaskJournal.FAILED)
+            METRICS.increment('failed')
+            job.error = job.error or 'Processing failed'
+        else:
+            METRICS.observe('end_to_end', time.monotonic() - job.created_at)
+            METRICS.increment('completed')
+        self.in_flight.release()
+        self.total_count += 1
+        if job.results is not None:
+            job.results.put_nowait(job)
+
+    async def create_stage(self, job: Job) -> bool:
+        if self.result_cache is not None:
+            job.cache_key = await asyncio.to_thread(self.result_cache.key, job.input_file_path)
+            # An identical file in flight is anonymized once, this job waits for its result
+            while (producing := self.result_cache.claim(job.cache_key)) is not None:
+                await asyncio.wrap_future(producing)
+            if await asyncio.to_thread(self.result_cache.fetch, job.cache_key, job.output_file_path):
+                logger.info(f"Use cached result for {job.relative_file_path}.")
+                METRICS.increment('cache_hits')
+                self.mark_done(job)
+                return False
+        start = time.monotonic()
+        job.task_id, job.upload_url = await self.create_task()
+        self.in_flight.success(time.monotonic() - start)
+        METRICS.observe('create', time.monotonic() - start)
+        self.record(job, TaskJournal.CREATED)
+        return True
+
+    async def upload_stage(self, job: Job) -> bool:
+        await self.upload_image(job.input_file_path, job.upload_url, job.input_data)
+        job.uploaded_at = time.monotonic()
+        self.record(job, TaskJournal.UPLOADED)
+        return True
+
+    async def download_stage(self, job: Job) -> bool:
+        with METRICS.timer('download'):
+            job.output_data = await self.download_image(job.output_file_path, job.task_id)
+        self.mark_done(job)
+        if job.cache_key is not None:
+            await asyncio.to_thread(self.result_cache.store, job.cache_key, job.output_file_path)
+        return True
+
+    def mark_done(self, job: Job):
+        self.record(job, TaskJournal.DONE)
+        if self.scan_index is not None:
+            self.scan_index.mark_done(job.relative_file_path)
+
+    async def create_task(self) -> (str, str):
+        async with self.http.request('POST', self.endpoint_task, data=json.dumps(self.anonymisation_configuration),
+                                     headers={'Authorization': self.token_manager.token}) as response:
+            if response.status in RETRY_STATUS_CODES:
+                raise ThrottledError(f'Creating task failed (Status {response.status}): {await response.text()}')
+            if response.status != 200:
+                raise RuntimeError(f'Creating task failed (Status {response.status}): {await response.text()}')
+            response_body = await response.json(content_type=None)
+
+        task_id = response_body['task_id']
+        logger.info(f"Task {task_id} created.")
+        return (task_id, response_body['upload_url'])
+
+    async def get_task_status(self, task_id: str):
+        async with self.http.request('GET', f'{self.endpoint_task}{task_id}/status', headers={'Authorization': self.token_manager.token}) as response:
+            if response.status != 200:
+                logger.error(f'Getting task status failed (Status {response.status}): {await response.text()}')
+                return response.status
+            status = (await response.json(content_type=None))['task_status']
+        logger.info(f'Task {task_id} has status: {status}')
+        return status
+
+    async def get_task(self, task_id: str) -> dict:
+        async with self.http.request('GET', f'{self.endpoint_task}{task_id}', headers={'Authorization': self.token_manager.token}) as response:
+            if response.status != 200:
+                raise RuntimeError(f'Getting task failed (Status {response.status}): {await response.text()}')
+            return await response.json(content_type=None)
+
+    async def upload_image(self, file_path: str, upload_url: str, data: bytes = None):
+        if data is not None:
+            start = time.monotonic()
+            async with self.http.request('PUT', upload_url, data=data) as response:
+                if response.status != 200:
+                    raise RuntimeError(f'Image upload failed (Status {response.status}): {await response.text()}')
+            METRICS.observe('upload', time.monotonic() - start)
+            METRICS.increment('upload_bytes', len(data))
+            return
+
+        # aiohttp streams the file in chunks from a thread pool instead of loading it into memory.
+        # It closes the file once it is sent, so every retry of the request opens the file again.
+        image_files = []
+
+        async def payload():
+            image_file = await asyncio.to_thread(open, file_path, 'rb')
+            image_files.append(image_file)
+            return aiohttp.payload.BufferedReaderPayload(image_file, disposition=None)
+
+        try:
+            upload_bytes = await asyncio.to_thread(os.path.getsize, file_path)
+            start = time.monotonic()
+            async with self.http.request('PUT', upload_url, payload=payload) as response:
+                if response.status != 200:
+                    raise RuntimeError(f'Image upload failed (Status {response.status}): {await response.text()}')
+                logger.info(f'Uploaded image {file_path} successfully.')
+            METRICS.observe('upload', time.monotonic() - start)
+            METRICS.increment('upload_bytes', upload_bytes)
+        finally:
+            for image_file in image_files:
+                await asyncio.to_thread(image_file.close)
+
+    async def download_image(self, output_file_name: str, task_id: str) -> bytes:
+        """
+        Write the anonymized image to `output_file_name`, or return it without a file name
+        """
+        task = await self.get_task(task_id)
+        async with self.http.request('GET', task['anonymized_url']) as response:
+            if response.status != 200:
+                raise RuntimeError(f'Downloading anonymized image failed (Status {response.status})')
+            if output_file_name is None:
+                logger.info(f'Task {task_id} completed.')
+                return await response.read()
+            with atomic_output_file(output_file_name) as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+        logger.info(f'[image {self.total_count}] Anonymized image {output_file_name} received.')
+        logger.info(f'Task {task_id} completed.')
+
+
+def is_array(item) -> bool:
+    return np is not None and isinstance(item, np.ndarray)
+
+
+def encode_image(image: 'np.ndarray', image_format: str) -> bytes:
+    success, buffer = cv2.imencode(image_format, image)
+    if not success:
+        raise ValueError(f'Encoding image of shape {image.shape} as {image_format} failed')
+    return buffer.tobytes()
+
+
+def decode_image(data: bytes) -> 'np.ndarray':
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError('Decoding anonymized image failed')
+    return image
+
+
+def relative_output_path(file_path: str, input_folder: str = None) -> str:
+    """
+    Path of the output file relative to the output folder, like the path of `file_path` relative to `input_folder`,
+    so files of different folders with the same name do not overwrite each other
+    """
+    # Raises ValueError for a path on another drive on Windows
+    relative_path = os.path.relpath(file_path, input_folder or os.curdir)
+    if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        raise ValueError(f'{file_path} is outside of the input folder {os.path.abspath(input_folder or os.curdir)}')
+    return relative_path
+
+
+class Result:
+    """
+    Outcome of one item submitted to `CelanturCloudClient.submit_many`.
+
+    For NumPy array inputs, the anonymized image is also decoded into `array`.
+    """
+    def __init__(self, index: int, item, data: bytes = None, output_path: str = None, task_id: str = None, error: str = None,
+                 array: 'np.ndarray' = None):
+        self.index = index
+        self.item = item
+        self.data = data
+        self.output_path = output_path
+        self.task_id = task_id
+        self.error = error
+        self.array = array
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return f'Result(index={self.index}, task_id={self.task_id}, output_path={self.output_path}, error={self.error})'
+
+
+class CelanturCloudClient:
+    """
+    Anonymize images from within an application instead of running the command line client.
+
+    All batches share one access token, one connection pool and one pipeline (see `AsyncEngine`):
+
+        async with CelanturCloudClient(username, password, configuration) as client:
+            async for result in client.submit_many(['image.jpg', image_bytes, image_array]):
+                ...
+
+    NumPy arrays (e.g. decoded video frames) are encoded as `image_format` in a pool of `codec_threads`
+    threads, without writing them to disk.
+    """
+    def __init__(self, username: str, password: str, anonymisation_configuration: dict,
+                 endpoint: str = 'https://api.celantur.com/v2/', max_in_flight: int = 200,
+                 image_format: str = '.jpg', codec_threads: int = 4, **engine_options):
+        self.username = username
+        self.password = password
+        self.anonymisation_configuration = anonymisation_configuration
+        self.endpoint = endpoint.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.engine_options = engine_options
+        self.image_format = image_format
+        self.codec_threads = codec_threads
+        self.session = None
+        self.token_manager = None
+        self.engine = None
+        self.codec_pool = None
+
+    async def __aenter__(self):
+        self.session = requests.Session()
+        self.token_manager = TokenManager(
+            lambda: request_token(self.session, f'{self.endpoint}/signin/', self.username, self.password))
+        await asyncio.to_thread(self.token_manager.start)
+        self.engine = AsyncEngine(self.token_manager, TaskJournal(), None, self.anonymisation_configuration, self.max_in_flight,
+                                  endpoint_task=f'{self.endpoint}/task/', **self.engine_options)
+        await self.engine.__aenter__()
+        # OpenCV releases the GIL while encoding, so threads use several cores
+        self.codec_pool = concurrent.futures.ThreadPoolExecutor(self.codec_threads, thread_name_prefix="Codec")
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        try:
+            await self.engine.__aexit__(exc_type, exc, traceback)
+        finally:
+            self.codec_pool.shutdown()
+            self.token_manager.stop()
+            self.session.close()
+
+    async def submit_many(self, items, output_folder: str = None, input_folder: str = None):
+        """
+        Anonymize the file paths, encoded images (bytes) or NumPy arrays of the iterable `items` and yield
+        a `Result` per item, in the order in which they finish.
+
+        Anonymized files are written to `output_folder` if given, under their path relative to `input_folder`
+        (default: the current directory), otherwise they are returned as `Result.data` like the results
+        of in-memory images. Files outside of `input_folder` fail.
+        """
+        loop = asyncio.get_running_loop()
+        results = asyncio.Queue()
+        submitted = 0
+        # Arrays are encoded ahead in the codec pool while earlier items are being submitted
+        encoding = collections.deque()
+
+        async def submit_next():
+            nonlocal submitted
+            index, item, encoded = encoding.popleft()
+            if isinstance(item, (bytes, bytearray, memoryview)) or encoded is not None:
+                job = Job(None, None, f'<image {index}>', bytes(item) if encoded is None else None)
+            else:
+                job = Job(os.fspath(item), None, os.fspath(item))
+            job.index = index
+            job.item = item
+            job.results = results
+            submitted += 1
+            try:
+                if encoded is not None:
+                    job.input_data = await encoded
+                elif job.input_file_path is not None and output_folder is not None:
+                    job.output_file_path = os.path.join(output_folder, relative_output_path(item, input_folder))
+            except Exception as e:
+                logger.error(f'Processing {job.relative_file_path} failed: {e}')
+                job.error = str(e)
+                results.put_nowait(job)
+                return
+            await self.engine.submit(job)
+
+        async def feed():
+            try:
+                for index, item in enumerate(items):
+                    encoded = loop.run_in_executor(self.codec_pool, encode_image, item, self.image_format) if is_array(item) else None
+                    encoding.append((index, item, encoded))
+                    if len(encoding) > self.codec_threads:
+                        await submit_next()
+                while encoding:
+                    await submit_next()
+            finally:
+                await results.put(STAGE_END)
+
+        feeder = asyncio.create_task(feed())
+        try:
+            fed = False
+            received = 0
+            while not fed or received < submitted:
+                job = await results.get()
+                if job is STAGE_END:
+                    fed = True
+                    continue
+                received += 1
+                array = None
+                if is_array(job.item) and job.output_data is not None:
+                    array = await loop.run_in_executor(self.codec_pool, decode_image, job.output_data)
+                yield Result(job.index, job.item, job.output_data, job.output_file_path if job.error is None else None,
+                             job.task_id, job.error, array)
+            await feeder  # Raise errors of the iterable
+        finally:
+            feeder.cancel()
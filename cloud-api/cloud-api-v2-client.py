@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import requests
+from urllib3.util.retry import Retry
 import time
 import json
 import threading
@@ -9,16 +10,41 @@ import os
 import queue
 import argparse
 import mimetypes
+import asyncio
+import heapq
+import concurrent.futures
+import http.server
+import zlib
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from celantur_cloud_client import (
+    SLEEP_TIME, HTTP_RETRIES, HTTP_BACKOFF_FACTOR, RETRY_STATUS_CODES, MAX_ATTEMPTS, DOWNLOAD_CHUNK_SIZE, STAGE_END, METRICS, Metrics, TaskJournal, ScanIndex, ResultCache, TokenManager, AimdLimit, StatusTracker,
+    AsyncEngine, ThrottledError, aiohttp, atomic_output_file, is_unknown_task, log_pool_statistics, request_token,
+)
 
 
-TASKS_PER_AUTHENTICATION = 50 # Number of tasks before re-authentication
-SLEEP_TIME = 10.0 # seconds wait time between querying request
-MAX_CHECK_STATUS = 1000 # Retry 1000 times to check status before stopping
 USERNAME: str
 PASSWORD: str
+HTTP_CLIENT: 'HttpClient'
+TOKEN_MANAGER: 'TokenManager'
+JOURNAL: 'TaskJournal'
+SCAN_INDEX: 'ScanIndex' = None
+RESULT_CACHE: 'ResultCache' = None
+LIMITER: 'AdaptiveLimiter'
+TRACKER: 'TaskTracker'
 EXTENSIONS = ['.jpg', '.jpeg', '.png']
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
 def parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
             description="Celantur Cloud API v2 Client",
@@ -29,8 +55,26 @@ def parser() -> argparse.ArgumentParser:
     parser.add_argument("-p", "--password", help="Password for Celantur Cloud API", required=True)
     parser.add_argument("-c", "--configuration", help="Anonymisation configuration as JSON file", required=True)
     parser.add_argument("-e", "--endpoint", help="Celantur Cloud API v2 endpoint", default='https://api.celantur.com/v2/')
-    parser.add_argument("--number-threads", help="Number of parallel threads", type=int, default=30)
+    parser.add_argument("--engine", help="Processing engine: one OS thread per task or a single asyncio event loop", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--number-threads", help="Number of parallel threads (threads engine)", type=int, default=30)
+    parser.add_argument("--max-in-flight", help="Maximum number of tasks in flight (asyncio engine)", type=int, default=200)
+    parser.add_argument("--initial-concurrency", help="Initial number of concurrent tasks, adapted to the API's capacity up to the maximum", type=int, default=10)
+    parser.add_argument("--create-concurrency", help="Parallel task creations (asyncio engine)", type=int, default=10)
+    parser.add_argument("--upload-concurrency", help="Parallel uploads (asyncio engine)", type=int, default=50)
+    parser.add_argument("--download-concurrency", help="Parallel downloads (asyncio engine)", type=int, default=50)
+    parser.add_argument("--poll-interval-min", help="Seconds until the first status check of a task", type=float, default=1.0)
+    parser.add_argument("--poll-interval-max", help="Maximum seconds between status checks of a task", type=float, default=SLEEP_TIME)
     parser.add_argument("--recursive", help="Recursively go through the input folder", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--journal", help="SQLite journal of all tasks to resume interrupted runs without re-uploading", default=None)
+    parser.add_argument("--index", help="SQLite index of the input folder for fast incremental rescans", default=None)
+    parser.add_argument("--scan-threads", help="Number of parallel directory scans (with --index)", type=int, default=8)
+    parser.add_argument("--cache-dir", help="Folder for caching results of identical input files and configuration", default=None)
+    parser.add_argument("--cache-size", help="Maximum size of the result cache in MB", type=int, default=10240)
+    parser.add_argument("--shards", help="Number of shards the input files are partitioned into by path hash", type=positive_int, default=1)
+    parser.add_argument("--shard-index", help="Process only these shards, e.g. on one of several machines (default: all shards in parallel processes)", type=int, nargs="+", default=None)
+    parser.add_argument("--metrics-port", help="Serve metrics in Prometheus text format on this port", type=int, default=None)
+    parser.add_argument("--metrics-file", help="JSON file periodically overwritten with a metrics snapshot", default=None)
+    parser.add_argument("--metrics-interval", help="Seconds between metrics snapshots (with --metrics-file)", type=float, default=10.0)
     parser.add_argument("--file-type", help="Select file type to anonymise", action="extend", nargs="+", type=str)
     return parser
 
@@ -70,7 +114,64 @@ def setup_logger(log_dir='logs'):
 
     return logger
 
-logger = setup_logger()
+logger = logging.getLogger('my_logger')
+
+
+class MetricsExporter:
+    """
+    Serve the metrics over HTTP for Prometheus and/or periodically write JSON snapshots to a file
+    """
+    def __init__(self, metrics: Metrics, port: int = None, file_path: str = None, interval: float = 10.0):
+        self.metrics = metrics
+        self.port = port
+        self.file_path = file_path
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(('', self.port), Handler)
+            threading.Thread(name="MetricsServer", target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics on port {self.port}.")
+        if self.file_path is not None:
+            self.thread = threading.Thread(name="MetricsWriter", target=self.write_periodically, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()  # Final snapshot at the end of the run
+
+    def write(self):
+        try:
+            with atomic_output_file(self.file_path) as f:
+                f.write(json.dumps(self.metrics.snapshot(), indent=2).encode())
+        except OSError as e:
+            logger.error(f"Writing metrics to {self.file_path} failed: {e}")
 
 
 def get_files_from_(root_path: str, relative_path: str, extensions: [str], recursive: bool) -> str:
@@ -88,49 +189,143 @@ def get_files_from_(root_path: str, relative_path: str, extensions: [str], recur
        raise SystemExit(-1)
     
     
-def get_files_without_overwrite_from_(root_input_path: str, root_output_path: str, input_queue: queue.Queue, recursive: bool, extensions: [str]):
-    """"""  """
-    Put input file paths into the queue
+def shard_of(relative_file_path: str, shards: int) -> int:
+    """
+    Shard of a file, the same on all machines and operating systems
     """
-    for file_path in get_files_from_(root_input_path, "", extensions, recursive):
+    return zlib.crc32(relative_file_path.replace(os.sep, '/').encode()) % shards
+
+
+def iter_files_without_overwrite_from_(root_input_path: str, root_output_path: str, recursive: bool, extensions: [str],
+                                       exclude: set = frozenset(), scan_index: 'ScanIndex' = None,
+                                       shards: int = 1, shard_index: int = 0):
+    """
+    Yield (input root, relative file path) for all input files without an existing output file,
+    except for the relative file paths in `exclude`.
+
+    With a `scan_index`, only changed directories are listed and completed files are skipped without checking the output.
+    With several `shards`, only the files of shard `shard_index` are yielded.
+    """
+    if scan_index is None:
+        file_paths = get_files_from_(root_input_path, "", extensions, recursive)
+    else:
+        file_paths = scan_index.scan(root_input_path, extensions, recursive)
+
+    for file_path in file_paths:
+        if shards > 1 and shard_of(file_path, shards) != shard_index:
+            continue
         output_path = os.path.join(root_output_path, file_path)
-        if os.path.exists(output_path):
+        if file_path in exclude:
+            logger.debug(f"Skip {file_path} because its task is resumed.")
+        elif os.path.exists(output_path):
             logger.info(f"Skip {file_path} because {output_path} already exists.")
+            METRICS.increment('skipped')
+            if scan_index is not None:
+                scan_index.mark_done(file_path)
         else:
-           input_queue.put((root_input_path, file_path))
-           logger.debug(f"Put into file queue: {file_path}")
+            yield (root_input_path, file_path)
+
+
+def get_files_without_overwrite_from_(root_input_path: str, root_output_path: str, input_queue: queue.Queue, recursive: bool, extensions: [str],
+                                      exclude: set = frozenset(), scan_index: 'ScanIndex' = None, shards: int = 1, shard_index: int = 0):
+    """
+    Put input file paths into the queue
+    """
+    for item in iter_files_without_overwrite_from_(root_input_path, root_output_path, recursive, extensions, exclude, scan_index,
+                                                   shards, shard_index):
+        input_queue.put(item)
+        logger.debug(f"Put into file queue: {item[1]}")
+
+
+def read_input(root_input_path: str, root_output_path: str, input_queue: queue.Queue, number_of_consumers: int, recursive: bool,
+               extensions: [str], exclude: set = frozenset(), scan_index: 'ScanIndex' = None, shards: int = 1, shard_index: int = 0):
+    """
+    Put input file paths into the queue, followed by one end-of-stream sentinel per consumer.
+
+    The bounded queue blocks the reader while the consumers are busy, so memory stays bounded for any input size.
+    """
+    try:
+        get_files_without_overwrite_from_(root_input_path, root_output_path, input_queue, recursive, extensions, exclude, scan_index,
+                                          shards, shard_index)
+    finally:
+        # Also stop the consumers if listing the input fails
+        for _ in range(number_of_consumers):
+            input_queue.put(STAGE_END)
            
 
-def authenticate():
-  data = {'username': USERNAME, 'password': PASSWORD}
-  response = requests.post(ENDPOINT_LOGIN, json=data, headers={'Content-Type':'application/json'})
-  resp_dict = response.json()
+
+class HttpClient:
+    """
+    Shared HTTP session with keep-alive connection pools per host and retry/backoff adapters.
+
+    All worker threads use the same session, so connections to the API and the storage are reused
+    instead of opening a new TCP+TLS connection for every request.
+    """
+    def __init__(self, pool_size: int = 10, retries: int = HTTP_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR):
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_CODES,
+                      raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def pool_statistics(self) -> dict:
+        """
+        Number of requests and opened connections per host
+        """
+        statistics = {}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                host = statistics.setdefault(pool.host, {'requests': 0, 'connections': 0})
+                host['requests'] += pool.num_requests
+                host['connections'] += pool.num_connections
+        return statistics
+
+
+def authenticate() -> (str, float):
   try:
-    auth_token = resp_dict['AccessToken']
-    # TODO implement logic for token renewal before expiration
-    # expires_in = resp_dict['ExpiresIn']  # 3600s
-    logger.info('Successfully authenticated and token received.')
-    return auth_token
-  except:
-     logger.error(f'Login error (Status {response.status_code}): {response.text}')
+    return request_token(HTTP_CLIENT.session, ENDPOINT_LOGIN, USERNAME, PASSWORD)
+  except RuntimeError as e:
+     logger.error(e)
      raise SystemExit(-1)
      
 
-def load_image(file_path: str):
-  try:
-    image_file = open(file_path,'rb')
-    image = image_file.read()
-    image_file.close()
-    logger.debug(f'Image loaded: {file_path}.')
-    return image
-  except Exception as e:
-    logger.error(f'Could not read image: {e}')
+
+class AdaptiveLimiter(AimdLimit):
+    """
+    Blocks threads while `limit` of them are active
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self, latency: float):
+        with self.condition:
+            super().success(latency)
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            super().throttled()
 
 
 def create_task(anonymisation_configuration: str, auth_token: str, mime_type: str):
   # Currently mime type checking not deployed yet
   # anonymisation_configuration["mime-type"] = mime_type  
-  response = requests.post(ENDPOINT_TASK, data=json.dumps(anonymisation_configuration), headers={'Authorization': auth_token})
+  response = HTTP_CLIENT.session.post(ENDPOINT_TASK, data=json.dumps(anonymisation_configuration), headers={'Authorization': auth_token})
 
   if response.status_code == 200:
     response_body = response.json()
@@ -140,6 +335,8 @@ def create_task(anonymisation_configuration: str, auth_token: str, mime_type: st
 
     logger.info(f"Task {task_id} created.")
     return (task_id, upload_url)
+  elif response.status_code in RETRY_STATUS_CODES:
+    raise ThrottledError(f'Creating task failed (Status {response.status_code}): {response.text}')
   else:
     raise RuntimeError(f'Creating task failed (Status {response.status_code}): {response.text}')
 
@@ -148,7 +345,7 @@ def get_task_status(task_id: str, auth_token: str) -> str:
   # stati: new, queued, processing, done or failed
   status_url = f'{ENDPOINT_TASK}{task_id}/status'
 
-  response = requests.get(status_url, headers={'Authorization': auth_token})  
+  response = HTTP_CLIENT.session.get(status_url, headers={'Authorization': auth_token})  
   if response.status_code == 200:
     response_body = response.json()
     status = response_body['task_status']
@@ -163,7 +360,7 @@ def get_task(task_id: str, auth_token: str):
   # stati: new, queued, processing, done or failed
   task_url = f'{ENDPOINT_TASK}{task_id}'
 
-  response = requests.get(task_url, headers={'Authorization': auth_token})  
+  response = HTTP_CLIENT.session.get(task_url, headers={'Authorization': auth_token})  
   if response.status_code == 200:
     logger.info(f'GET /task/{task_id} successful.')
     response_body = response.json()
@@ -174,54 +371,175 @@ def get_task(task_id: str, auth_token: str):
 
 
 def upload_image(file_path: str, upload_url: str):
-  img = load_image(file_path)
-  response = requests.put(url=upload_url, data=img)
+  # Stream the file from disk in chunks instead of loading it into memory
+  try:
+    with open(file_path, 'rb') as image_file:
+      start = time.monotonic()
+      response = HTTP_CLIENT.session.put(url=upload_url, data=image_file)
+      upload_time = time.monotonic() - start
+      upload_bytes = image_file.tell()
+  except OSError as e:
+    logger.error(f'Could not read image: {e}')
+    return False
   if response.status_code == 200:
     logger.info(f'Uploaded image {file_path} successfully.')
+    METRICS.observe('upload', upload_time)
+    METRICS.increment('upload_bytes', upload_bytes)
     return True
   else:
     logger.error(f'Image upload failed (Status {response.status_code}): {response.text}')
     return False
 
 
-def download_image(output_file_name: str, task_id: str, auth_token: str, sleep_time: float):
-  global total_count
-  counter = 1
-  while counter < MAX_CHECK_STATUS:
-    task_status = get_task_status(task_id, auth_token)
-    if task_status == "done":
-      break
-    logger.info(f"[Retry {counter}/{MAX_CHECK_STATUS}] Status: {task_status}, sleeping {sleep_time} seconds ...")
-    counter += 1
-    time.sleep(sleep_time)
-  else:
-     if task_status != 'done':
-        logger.warning(f"The task {task_id} did not finish.")
-  
-  task = get_task(task_id, auth_token)
-
-  anonymized_url = task['anonymized_url']
-  response = requests.get(anonymized_url)
-  os.makedirs(os.path.dirname(output_file_name), exist_ok=True)  
-  with open(output_file_name, 'wb') as f:
-    f.write(response.content)
-  logger.info(f'[image {total_count}] Anonymized image {output_file_name} received.')
+def wait_for_task(task_id: str, resumed: bool = False) -> bool:
+  """
+  Wait until the task is done. Returns False for a resumed task which the API does not know anymore.
+  """
+  # The status is polled by the central tracker together with the tasks of all other threads
+  start = time.monotonic()
+  task_status = TRACKER.track(task_id, resumed).result()
+  if resumed and is_unknown_task(task_status):
+    return False
+  if task_status != 'done':
+    raise RuntimeError(f'The task {task_id} failed' if task_status == 'failed' else f'The task {task_id} did not finish')
+  METRICS.observe('processing', time.monotonic() - start)
+  return True
+
+
+def download_image(output_file_name: str, task_id: str, token_manager: TokenManager):
+  with METRICS.timer('download'):
+    task = get_task(task_id, token_manager.token)
+    if not task:
+      raise RuntimeError(f'Getting task {task_id} failed')
+
+    anonymized_url = task['anonymized_url']
+    with HTTP_CLIENT.session.get(anonymized_url, stream=True) as response:
+      response.raise_for_status()
+      with atomic_output_file(output_file_name) as f:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+          f.write(chunk)
+  logger.info(f'Anonymized image {output_file_name} received.')
   logger.info(f'Task {task_id} completed.')
 
 
+def retry_step(relative_file_path: str, step, *args):
+  """
+  Call `step` with `args`, retrying failures with backoff like `AsyncEngine.attempt`.
+
+  Only the failed step is repeated, e.g. a failed download does not create and upload a new task.
+  """
+  for attempt in range(1, MAX_ATTEMPTS + 1):
+    try:
+      return step(*args)
+    except Exception as e:
+      if isinstance(e, ThrottledError):
+        LIMITER.throttled()
+        METRICS.increment('throttled')
+      if attempt == MAX_ATTEMPTS:
+        raise
+      METRICS.increment('retries')
+      backoff = HTTP_BACKOFF_FACTOR * 2 ** attempt
+      logger.warning(f'Processing {relative_file_path} failed (attempt {attempt}/{MAX_ATTEMPTS}), retrying in {backoff} seconds: {e}')
+      time.sleep(backoff)
+
+
+def create_and_upload(input_file_path: str, relative_file_path: str, anonymisation_configuration: dict) -> str:
+  mime_type = mimetypes.guess_type(input_file_path)[0]
+
+  def create():
+    start = time.monotonic()
+    created = create_task(anonymisation_configuration, TOKEN_MANAGER.token, mime_type)
+    LIMITER.success(time.monotonic() - start)
+    METRICS.observe('create', time.monotonic() - start)
+    return created
+
+  def upload():
+    if not upload_image(input_file_path, upload_url):
+      raise RuntimeError(f'Uploading {input_file_path} failed')
+
+  task_id, upload_url = retry_step(relative_file_path, create)
+  JOURNAL.record(relative_file_path, task_id, TaskJournal.CREATED)
+  try:
+    # The upload URL of the task is used again instead of creating another task
+    retry_step(relative_file_path, upload)
+  except Exception:
+    JOURNAL.record(relative_file_path, task_id, TaskJournal.FAILED)
+    raise
+  JOURNAL.record(relative_file_path, task_id, TaskJournal.UPLOADED)
+  return task_id
+
+
+def process_file(input_root_path: str, relative_file_path: str, resumed_task_id: str, output_folder: str, anonymisation_configuration: dict):
+  input_file_path = os.path.join(input_root_path, relative_file_path)
+  output_file_path = os.path.join(output_folder, relative_file_path)
+  cache_key = None
+  task_id = resumed_task_id
+
+  def wait(resumed: bool = False) -> bool:
+    # Recorded as failed like in `AsyncEngine.finish`, so the next run creates a new task instead of resuming it again
+    try:
+      return wait_for_task(task_id, resumed)
+    except Exception:
+      JOURNAL.record(relative_file_path, task_id, TaskJournal.FAILED)
+      raise
+
+  if task_id is not None:
+    logger.info(f"Resume task {task_id} of {relative_file_path}.")
+    if not wait(resumed=True):
+      logger.warning(f"Task {task_id} of {relative_file_path} is unknown to the API, creating a new task.")
+      task_id = None
+  if task_id is None and RESULT_CACHE is not None:
+    cache_key = RESULT_CACHE.key(input_file_path)
+    # An identical file in flight is anonymized once, this thread waits for its result
+    while (producing := RESULT_CACHE.claim(cache_key)) is not None:
+      producing.result()
+    if RESULT_CACHE.fetch(cache_key, output_file_path):
+      logger.info(f"Use cached result for {relative_file_path}.")
+      METRICS.increment('cache_hits')
+      mark_done(relative_file_path, None)
+      return
+
+  try:
+    if task_id is None:
+      task_id = create_and_upload(input_file_path, relative_file_path, anonymisation_configuration)
+      wait()
+
+    retry_step(relative_file_path, download_image, output_file_path, task_id, TOKEN_MANAGER)
+    if cache_key is not None:
+      RESULT_CACHE.store(cache_key, output_file_path)
+  finally:
+    if cache_key is not None:
+      RESULT_CACHE.release(cache_key)
+  mark_done(relative_file_path, task_id)
+
+
+def mark_done(relative_file_path: str, task_id: str):
+  JOURNAL.record(relative_file_path, task_id, TaskJournal.DONE)
+  if SCAN_INDEX is not None:
+    SCAN_INDEX.mark_done(relative_file_path)
+
+
 def run_test(input_queue: queue.Queue, output_folder: str, anonymisation_configuration: dict):
-  global auth_token, total_count
-  while not input_queue.empty():
-    input_root_path, relative_file_path = input_queue.get()
-    input_file_path = os.path.join(input_root_path, relative_file_path)
-    mime_type = mimetypes.guess_type(input_file_path)[0]
-    task_id, upload_url = create_task(anonymisation_configuration, auth_token, mime_type)
-    output_file_path = os.path.join(output_folder, relative_file_path)
-    if upload_image(input_file_path, upload_url):
-      download_image(output_file_path, task_id, auth_token, SLEEP_TIME)
-    total_count += 1
-    if total_count % TASKS_PER_AUTHENTICATION == 0:  # Re-authenticate
-        auth_token = authenticate()
+  global total_count
+  # Wait for items until the end of the input instead of stopping whenever the reader lags behind
+  while (item := input_queue.get()) is not STAGE_END:
+    # Resumed tasks from the journal come with their task ID
+    input_root_path, relative_file_path, *resumed_task_id = item
+    resumed_task_id = resumed_task_id[0] if resumed_task_id else None
+    start = time.monotonic()
+    # Failed steps are retried within process_file, a failed file does not end the worker thread
+    try:
+      wait_start = time.monotonic()
+      with LIMITER:
+        METRICS.observe('queue_wait', time.monotonic() - wait_start)
+        process_file(input_root_path, relative_file_path, resumed_task_id, output_folder, anonymisation_configuration)
+      METRICS.observe('end_to_end', time.monotonic() - start)
+      METRICS.increment('completed')
+    except Exception as e:
+      logger.error(f'Processing {relative_file_path} failed: {e}')
+      METRICS.increment('failed')
+    with total_count_lock:
+      total_count += 1
 
 
 def read_configuration_file(file_name: str) -> dict:
@@ -232,12 +550,150 @@ def read_configuration_file(file_name: str) -> dict:
        return json.load(fp)
 
 
+def shard_file_path(file_path: str, shard_index: int) -> str:
+    root, extension = os.path.splitext(file_path)
+    return f'{root}.shard-{shard_index}{extension}'
+
+
+def without_options(argv: [str], options: [str]) -> [str]:
+    """
+    Remove the `options` and their values from the command line arguments `argv`
+    """
+    result = []
+    skip_values = False
+    for argument in argv:
+        if argument.startswith('-'):
+            skip_values = argument in options
+            if skip_values or argument.split('=', 1)[0] in options:
+                continue
+        if not skip_values:
+            result.append(argument)
+    return result
+
+
+def run_shards(argv: [str], shard_indices: [int], journal: str, index: str, interval: float) -> int:
+    """
+    Process each shard in its own process with its own connection pool, journal and index.
+
+    The metrics snapshots of the processes are summed up into `METRICS` and logged as progress.
+    Returns the number of failed processes, i.e. processes which crashed or failed to process any of their files.
+    """
+    snapshot_folder = tempfile.mkdtemp(prefix='celantur-shards-')
+    shard_argv = without_options(argv, ['--shard-index', '--journal', '--index', '--metrics-port', '--metrics-file', '--metrics-interval'])
+    processes = {}
+    for shard_index in shard_indices:
+        command = [sys.executable, os.path.abspath(__file__), *shard_argv, '--shard-index', str(shard_index),
+                   '--metrics-file', os.path.join(snapshot_folder, f'shard-{shard_index}.json'), '--metrics-interval', str(interval)]
+        if journal is not None:
+            command += ['--journal', shard_file_path(journal, shard_index)]
+        if index is not None:
+            command += ['--index', shard_file_path(index, shard_index)]
+        processes[shard_index] = subprocess.Popen(command)
+    logger.info(f"Started {len(processes)} shard processes.")
+
+    def collect():
+        snapshots = []
+        for shard_index in processes:
+            try:
+                with open(os.path.join(snapshot_folder, f'shard-{shard_index}.json')) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                pass  # No snapshot written yet
+        METRICS.load(snapshots)
+
+    while running := [shard_index for shard_index, process in processes.items() if process.poll() is None]:
+        time.sleep(interval)
+        collect()
+        counters = METRICS.snapshot()['counters']
+        logger.info(f"Shards {running} running: {counters.get('completed', 0)} completed, {counters.get('failed', 0)} failed, "
+                    f"{counters.get('skipped', 0)} skipped.")
+    collect()
+    shutil.rmtree(snapshot_folder, ignore_errors=True)
+
+    failed = [shard_index for shard_index, process in processes.items() if process.returncode != 0]
+    if failed:
+        logger.error(f"Shards {failed} failed.")
+    return len(failed)
+
+
 def create_thread(*run_test_args) -> threading.Thread:
   thread = threading.Thread(target=run_test, args=run_test_args)
   thread.start()
   return thread
 
 
+class TaskTracker(StatusTracker):
+    """
+    Threads engine counterpart of `StatusTracker`.
+
+    One background thread polls the due tasks of all worker threads together, `poll_concurrency` at a time.
+    The worker threads only wait for the final status of their task instead of polling it in their own sleep loop.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def schedule(self, job, polls: int = 0):
+        heapq.heappush(self.pending, (time.monotonic() + self.interval(polls), self.sequence, polls, job))
+        self.sequence += 1
+
+    def start(self):
+        self.thread = threading.Thread(name="StatusTracker", target=self.poll_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def track(self, task_id: str, resumed: bool = False) -> concurrent.futures.Future:
+        """
+        Future of the final status of the task: "done", "failed", or the last status after `max_checks` polls.
+        For a `resumed` task the API does not know anymore, the status code of the failed status request.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.schedule((task_id, future, resumed))
+            self.condition.notify_all()
+        return future
+
+    def poll(self, task_id: str):
+        try:
+            return self.get_task_status(task_id)
+        except Exception as e:
+            logger.error(f'Getting task status of {task_id} failed: {e}')
+            return None
+
+    def poll_forever(self):
+        with concurrent.futures.ThreadPoolExecutor(self.poll_concurrency, thread_name_prefix='Poll') as executor:
+            while True:
+                with self.condition:
+                    while not self.stopped and (not self.pending or self.pending[0][0] > time.monotonic()):
+                        self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                    if self.stopped:
+                        return
+                    now = time.monotonic()
+                    due = []
+                    while self.pending and self.pending[0][0] <= now:
+                        _, _, polls, job = heapq.heappop(self.pending)
+                        due.append((polls + 1, job))
+
+                statuses = list(executor.map(self.poll, [task_id for _, (task_id, _, _) in due]))
+                with self.condition:
+                    for (polls, (task_id, future, resumed)), task_status in zip(due, statuses):
+                        if task_status in ("done", "failed") or (resumed and is_unknown_task(task_status)):
+                            future.set_result(task_status)
+                        elif polls >= self.max_checks:
+                            logger.warning(f"The task {task_id} did not finish.")
+                            future.set_result(task_status)
+                        else:
+                            self.schedule((task_id, future, resumed), polls)
+
+
 def normalise_file_extensions(extensions: [str]):
     """Ensure that the file extensions start with a dot and are lowercase."""
     if extensions is None or []:
@@ -257,7 +713,9 @@ def normalise_file_extensions(extensions: [str]):
    
 
 if __name__ == "__main__":
+    setup_logger()
     total_count = 0
+    total_count_lock = threading.Lock()
     # Measure the execution time
     start_time = time.time()
     args = parser().parse_args()
@@ -271,23 +729,86 @@ if __name__ == "__main__":
     PASSWORD = args.password
     
 
-    logger.info(f"Start Cloud API v2 Client with {args.number_threads} threads.")
-
-    input_queue = queue.Queue(maxsize=100)
-    file_reader = threading.Thread(name="ReadInput", target=get_files_without_overwrite_from_, 
-                                   args=(args.input, args.output, input_queue, args.recursive, dotted_extensions)
-                                  )
-    file_reader.start()
-
-    auth_token = authenticate()
+    metrics_exporter = MetricsExporter(METRICS, args.metrics_port, args.metrics_file, args.metrics_interval)
+    metrics_exporter.start()
+
+    shard_indices = args.shard_index if args.shard_index is not None else list(range(args.shards))
+    if any(not 0 <= shard_index < args.shards for shard_index in shard_indices):
+        logger.error(f"Shard indices must be between 0 and {args.shards - 1}.")
+        raise SystemExit(-1)
+    if len(shard_indices) > 1:
+        # Supervise one process per shard to use several cores
+        failed_shards = run_shards(sys.argv[1:], shard_indices, args.journal, args.index, args.metrics_interval)
+        metrics_exporter.stop()
+        METRICS.log_summary()
+        elapsed_time = time.time() - start_time
+        logger.info(f"Completed. It took {int(elapsed_time)} seconds ({elapsed_time//60} minutes)")
+        raise SystemExit(1 if failed_shards or METRICS.snapshot()['counters'].get('failed', 0) else 0)
+    shard_index = shard_indices[0]
+    if args.shards > 1:
+        logger.info(f"Process shard {shard_index} of {args.shards}.")
+
+    HTTP_CLIENT = HttpClient(pool_size=args.number_threads)
+    TOKEN_MANAGER = TokenManager(authenticate)
+    JOURNAL = TaskJournal(args.journal)
+    if args.index is not None:
+        SCAN_INDEX = ScanIndex(args.index, args.scan_threads)
+    if args.cache_dir is not None:
+        RESULT_CACHE = ResultCache(args.cache_dir, args.cache_size * 1024 * 1024, configuration)
+    resumed = JOURNAL.pending()
+    if resumed:
+        logger.info(f"Resume {len(resumed)} uploaded tasks from journal {args.journal}.")
+
+    if args.engine == "asyncio":
+        if aiohttp is None:
+            logger.error("The asyncio engine requires aiohttp: pip install aiohttp")
+            raise SystemExit(-1)
+        logger.info(f"Start Cloud API v2 Client with asyncio engine and up to {args.max_in_flight} tasks in flight.")
+        TOKEN_MANAGER.start()
+        files = iter_files_without_overwrite_from_(args.input, args.output, args.recursive, dotted_extensions, resumed.keys(), SCAN_INDEX,
+                                                   args.shards, shard_index)
+        engine = AsyncEngine(TOKEN_MANAGER, JOURNAL, args.output, configuration, args.max_in_flight,
+                             args.create_concurrency, args.upload_concurrency, args.download_concurrency,
+                             args.poll_interval_min, args.poll_interval_max, SCAN_INDEX, RESULT_CACHE,
+                             args.initial_concurrency, ENDPOINT_TASK, args.input)
+        asyncio.run(engine.run(files, resumed))
+    else:
+        logger.info(f"Start Cloud API v2 Client with {args.number_threads} threads.")
+        LIMITER = AdaptiveLimiter(args.initial_concurrency, args.number_threads)
+        TRACKER = TaskTracker(lambda task_id: get_task_status(task_id, TOKEN_MANAGER.token),
+                              args.poll_interval_min, args.poll_interval_max)
+        TRACKER.start()
+
+        input_queue = queue.Queue(maxsize=100 + len(resumed))
+        for relative_file_path, task_id in resumed.items():
+            input_queue.put((args.input, relative_file_path, task_id))
+        file_reader = threading.Thread(name="ReadInput", target=read_input,
+                                       args=(args.input, args.output, input_queue, args.number_threads, args.recursive, dotted_extensions, resumed.keys(), SCAN_INDEX,
+                                             args.shards, shard_index)
+                                      )
+        TOKEN_MANAGER.start()
+        file_reader.start()
+
+        threads = [create_thread(input_queue, args.output, configuration) for _ in range(args.number_threads)]
+        for t in threads:
+            t.join()
+        file_reader.join()
+        TRACKER.stop()
+        log_pool_statistics(HTTP_CLIENT.pool_statistics())
+    TOKEN_MANAGER.stop()
+    JOURNAL.close()
+    if SCAN_INDEX is not None:
+        SCAN_INDEX.close()
+    metrics_exporter.stop()
+    METRICS.log_summary()
 
-    threads = [create_thread(input_queue, args.output, configuration) for _ in range(args.number_threads)]
-    for t in threads:
-        t.join()
-    file_reader.join()
     end_time = time.time()
 
     # Calculate the elapsed time
     elapsed_time = end_time - start_time
     logger.info(f"Completed. It took {int(elapsed_time)} seconds ({elapsed_time//60} minutes)")
+    failed = METRICS.snapshot()['counters'].get('failed', 0)
+    if failed:
+        logger.error(f"Processing {failed} files failed.")
+        raise SystemExit(1)
 
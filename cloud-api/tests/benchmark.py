@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+Throughput benchmark of the Cloud API v2 client against the local mock server.
+
+Runs the client for every engine and concurrency setting on the same generated input files and reports
+images per second, end-to-end latency percentiles and the peak memory of the client process, e.g.
+
+    python cloud-api/tests/benchmark.py --images 500 --concurrency 10 50 200 --processing-time 1
+
+Peak memory is measured with os.wait4, which is not available on Windows.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_server import MockCelanturServer
+
+CLIENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cloud-api-v2-client.py')
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+            description="Benchmark of the Celantur Cloud API v2 client",
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--images", help="Number of generated input images", type=int, default=200)
+    parser.add_argument("--image-size", help="Size of each input image in KB", type=int, default=500)
+    parser.add_argument("--engines", help="Client engines to compare", nargs="+", choices=["threads", "asyncio"], default=["threads", "asyncio"])
+    parser.add_argument("--concurrency", help="Number of threads or tasks in flight", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--latency", help="Seconds added to every response of the mock server", type=float, default=0.05)
+    parser.add_argument("--processing-time", help="Seconds from upload until a task is done", type=float, default=0.5)
+    parser.add_argument("--error-rate", help="Fraction of requests failing with status 500", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help="Fraction of task creations throttled with status 429", type=float, default=0.0)
+    parser.add_argument("--poll-interval", help="Maximum seconds between status checks", type=float, default=1.0)
+    parser.add_argument("--json", help="Write the results to this JSON file, e.g. to compare runs", default=None)
+    return parser
+
+
+def create_images(folder: str, number: int, size: int):
+    for i in range(number):
+        with open(os.path.join(folder, f'image-{i:06d}.jpg'), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def run_client(engine: str, concurrency: int, input_folder: str, work_folder: str, endpoint: str, poll_interval: float) -> dict:
+    """
+    Run the client once and return its measurements
+    """
+    output_folder = tempfile.mkdtemp(prefix='output-', dir=work_folder)
+    metrics_file = os.path.join(work_folder, f'metrics-{engine}-{concurrency}.json')
+    configuration_file = os.path.join(work_folder, 'configuration.json')
+    with open(configuration_file, 'w') as f:
+        json.dump({}, f)
+    command = [sys.executable, CLIENT, '-i', input_folder, '-o', output_folder, '-u', 'benchmark', '-p', 'benchmark',
+               '-c', configuration_file, '-e', endpoint, '--engine', engine,
+               '--number-threads', str(concurrency), '--max-in-flight', str(concurrency), '--initial-concurrency', str(concurrency),
+               '--poll-interval-max', str(poll_interval), '--metrics-file', metrics_file]
+
+    start = time.monotonic()
+    process = subprocess.Popen(command, cwd=work_folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    end_to_end = metrics['stages'].get('end_to_end', {})
+    completed = metrics['counters'].get('completed', 0)
+    return {
+        'engine': engine,
+        'concurrency': concurrency,
+        'exit_code': process.returncode,
+        'completed': completed,
+        'failed': metrics['counters'].get('failed', 0),
+        'seconds': elapsed,
+        'images_per_second': completed / elapsed,
+        'p50_seconds': end_to_end.get('p50'),
+        'p99_seconds': end_to_end.get('p99'),
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        'peak_rss_mb': usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    }
+
+
+def print_results(results: [dict]):
+    print(f"{'engine':<8} {'concurrency':>11} {'completed':>9} {'failed':>6} {'images/s':>9} {'p50 s':>7} {'p99 s':>7} {'peak RSS MB':>11}")
+    for r in results:
+        print(f"{r['engine']:<8} {r['concurrency']:>11} {r['completed']:>9} {r['failed']:>6} {r['images_per_second']:>9.1f} "
+              f"{r['p50_seconds'] or 0:>7.2f} {r['p99_seconds'] or 0:>7.2f} {r['peak_rss_mb']:>11.1f}")
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    with tempfile.TemporaryDirectory(prefix='celantur-benchmark-') as work_folder, \
+         MockCelanturServer(latency=args.latency, processing_time=args.processing_time,
+                            error_rate=args.error_rate, throttle_rate=args.throttle_rate) as server:
+        input_folder = os.path.join(work_folder, 'input')
+        os.makedirs(input_folder)
+        create_images(input_folder, args.images, args.image_size * 1024)
+
+        results = []
+        for engine in args.engines:
+            for concurrency in args.concurrency:
+                results.append(run_client(engine, concurrency, input_folder, work_folder, server.endpoint, args.poll_interval))
+                print(f"{engine} engine with concurrency {concurrency}: {results[-1]['images_per_second']:.1f} images/s", flush=True)
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
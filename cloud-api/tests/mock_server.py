@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+"""
+Local stand-in for the Celantur Cloud API v2 to test and benchmark clients offline.
+
+The "anonymized" image is the uploaded image itself.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockCelanturServer:
+    """
+    Serves /signin/, /task/, /task/{id}/status, /task/{id} and the upload and download URLs of the tasks.
+
+    Every response is delayed by `latency` seconds, tasks are done `processing_time` seconds after their upload.
+    Requests fail with status 500 at `error_rate` and task creations are throttled with 429 at `throttle_rate`.
+    The first `failing_uploads` uploads fail with status 503, like a briefly unavailable storage,
+    and the first `failing_downloads` downloads with status 404. The tasks in `failed_tasks` fail.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, processing_time: float = 0.2,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, expires_in: float = 3600.0, failing_uploads: int = 0,
+                 failing_downloads: int = 0, failed_tasks: set = ()):
+        self.latency = latency
+        self.processing_time = processing_time
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.expires_in = expires_in
+        self.failing_uploads = failing_uploads
+        self.failing_downloads = failing_downloads
+        self.failed_tasks = set(failed_tasks)
+        self.tasks = {}  # task ID -> {'uploaded': time of upload, 'data': uploaded image}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v2/'
+
+    def start(self):
+        self.thread = threading.Thread(name="MockServer", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive like the real API
+
+            def log_message(self, format, *args):
+                pass
+
+            def send(self, status: int, body, content_type: str = 'application/json'):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def prepare(self) -> bool:
+                """
+                Simulate latency and server errors, returns False if the request failed
+                """
+                with mock.lock:
+                    mock.requests += 1
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if random.random() < mock.error_rate:
+                    self.send(500, {'error': 'internal server error'})
+                    return False
+                return True
+
+            def task(self, task_id: str) -> dict:
+                task = mock.tasks.get(task_id)
+                if task is None:
+                    self.send(404, {'error': f'task {task_id} not found'})
+                return task
+
+            def do_POST(self):
+                self.read_body()
+                if not self.prepare():
+                    return
+                if self.path.rstrip('/').endswith('/signin'):
+                    return self.send(200, {'AccessToken': uuid.uuid4().hex, 'ExpiresIn': mock.expires_in})
+                if random.random() < mock.throttle_rate:
+                    return self.send(429, {'error': 'too many requests'})
+                task_id = uuid.uuid4().hex
+                mock.tasks[task_id] = {'uploaded': None, 'data': None}
+                self.send(200, {'task_id': task_id, 'upload_url': f'http://{self.headers["Host"]}/upload/{task_id}'})
+
+            def do_PUT(self):
+                data = self.read_body()
+                if not self.prepare():
+                    return
+                with mock.lock:
+                    failing = mock.failing_uploads > 0
+                    mock.failing_uploads -= failing
+                if failing:
+                    return self.send(503, {'error': 'service unavailable'})
+                task = self.task(self.path.rsplit('/', 1)[1])
+                if task is not None:
+                    task['data'] = data
+                    task['uploaded'] = time.monotonic()
+                    self.send(200, b'', 'text/plain')
+
+            def do_GET(self):
+                if not self.prepare():
+                    return
+                parts = self.path.strip('/').split('/')
+                if parts[0] == 'download':
+                    with mock.lock:
+                        failing = mock.failing_downloads > 0
+                        mock.failing_downloads -= failing
+                    if failing:
+                        return self.send(404, {'error': 'not found'})
+                    task = self.task(parts[1])
+                    if task is not None:
+                        self.send(200, task['data'], 'application/octet-stream')
+                    return
+                # /v2/task/{id} or /v2/task/{id}/status
+                task = self.task(parts[2])
+                if task is None:
+                    return
+                if len(parts) == 4:
+                    done = task['uploaded'] is not None and time.monotonic() - task['uploaded'] >= mock.processing_time
+                    status = 'done' if done else 'processing' if task['uploaded'] is not None else 'new'
+                    if parts[2] in mock.failed_tasks:
+                        status = 'failed'
+                    return self.send(200, {'task_status': status})
+                self.send(200, {'task_id': parts[2], 'anonymized_url': f'http://{self.headers["Host"]}/download/{parts[2]}'})
+
+        return Handler
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+            description="Mock Celantur Cloud API v2 server",
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", help="Seconds added to every response", type=float, default=0.0)
+    parser.add_argument("--processing-time", help="Seconds from upload until a task is done", type=float, default=0.2)
+    parser.add_argument("--error-rate", help="Fraction of requests failing with status 500", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help="Fraction of task creations throttled with status 429", type=float, default=0.0)
+    return parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    server = MockCelanturServer(args.host, args.port, args.latency, args.processing_time, args.error_rate, args.throttle_rate)
+    print(f"Mock Celantur Cloud API v2 on {server.endpoint}")
+    server.server.serve_forever()
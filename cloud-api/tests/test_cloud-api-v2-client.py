@@ -3,8 +3,20 @@ import os
 from unittest.mock import patch, Mock
 import importlib
 import queue
+import asyncio
+import time
+import threading
+import subprocess
+import sys
+import tempfile
+import sqlite3
+import contextlib
 
+# The client script imports the library module from its own folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+cloud_client = importlib.import_module('celantur_cloud_client')
 client_api = importlib.import_module('cloud-api.cloud-api-v2-client')
+mock_server = importlib.import_module('cloud-api.tests.mock_server')
 
 class DirEntryMock:
     def __init__(self, path: str, is_file: bool = True):
@@ -110,4 +122,479 @@ class TestReadFilesFromFolder(unittest.TestCase):
                 result.append(test_queue.get())
             print(result)
             expected = [('mock-test', 'b.jpg'), ('mock-test', 'd.png'), ('mock-test', 'subdirectory/e.JPG'), ('mock-test', 'subdirectory/g.PNG')]
-            self.assertListEqual(expected, result)
\ No newline at end of file
+            self.assertListEqual(expected, result)
+
+            # Test end-of-stream sentinels for the consumers, with a queue smaller than the input
+            test_queue = queue.Queue(maxsize=2)
+            consumers = 3
+            results = [[] for _ in range(consumers)]
+
+            def consume(result):
+                while (item := test_queue.get()) is not client_api.STAGE_END:
+                    time.sleep(0.01)
+                    result.append(item)
+
+            threads = [threading.Thread(target=consume, args=(result,)) for result in results]
+            for t in threads:
+                t.start()
+            client_api.read_input(self.ROOT_PATH, self.OUTPUT_PATH, test_queue, consumers, recursive=True, extensions=[".jpg", ".png"])
+            for t in threads:
+                t.join()
+            self.assertListEqual(expected, sorted(item for result in results for item in result))
+
+class TestStatusTracker(unittest.TestCase):
+    def test_backoff_interval(self):
+        tracker = cloud_client.StatusTracker(None, min_interval=1.0, max_interval=10.0, backoff=2.0)
+        self.assertListEqual([1.0, 2.0, 4.0, 8.0, 10.0, 10.0], [tracker.interval(polls) for polls in range(6)])
+
+    def test_track_jobs(self):
+        stati = {'a': ['processing', 'done'], 'b': ['failed'], 'c': ['queued', 'processing', 'done']}
+
+        async def get_task_status(task_id):
+            return stati[task_id].pop(0)
+
+        async def track():
+            tracker = cloud_client.StatusTracker(get_task_status, min_interval=0.01, max_interval=0.02)
+            in_queue, out_queue = asyncio.Queue(), asyncio.Queue()
+            finished = []
+
+            async def finish(job):
+                finished.append(job.task_id)
+
+            for task_id in stati:
+                job = cloud_client.Job(task_id, task_id)
+                job.task_id = task_id
+                await in_queue.put(job)
+            await in_queue.put(cloud_client.STAGE_END)
+            await tracker.run(in_queue, out_queue, finish)
+
+            done = []
+            while (job := out_queue.get_nowait()) is not cloud_client.STAGE_END:
+                done.append(job.task_id)
+            return done, finished
+
+        done, finished = asyncio.run(track())
+        self.assertListEqual(['a', 'c'], done)
+        self.assertListEqual(['b'], finished)
+
+    def test_track_tasks_in_threads(self):
+        stati = {'a': ['processing', 'done'], 'b': ['failed'], 'c': ['queued', None, 'done'], 'd': ['processing'] * 5}
+        polled = []
+
+        def get_task_status(task_id):
+            polled.append(threading.current_thread().name)
+            return stati[task_id].pop(0)
+
+        tracker = client_api.TaskTracker(get_task_status, min_interval=0.01, max_interval=0.02, max_checks=3)
+        tracker.start()
+        futures = {task_id: tracker.track(task_id) for task_id in stati}
+        results = {task_id: future.result(timeout=5) for task_id, future in futures.items()}
+        tracker.stop()
+        self.assertDictEqual({'a': 'done', 'b': 'failed', 'c': 'done', 'd': 'processing'}, results)
+        # Polled by the tracker, not by the threads waiting for the results
+        self.assertTrue(all(name.startswith('Poll') for name in polled))
+
+    def test_recreate_unknown_resumed_tasks(self):
+        stati = {'old': [404], 'new': ['done'], 'fresh': [404, 'done']}
+
+        async def get_task_status(task_id):
+            return stati[task_id].pop(0)
+
+        async def track():
+            tracker = cloud_client.StatusTracker(get_task_status, min_interval=0.01, max_interval=0.02)
+            in_queue, out_queue = asyncio.Queue(), asyncio.Queue()
+
+            async def recreate(job):
+                job.task_id = 'new'
+                return True
+
+            resumed, fresh = cloud_client.Job('old', 'old'), cloud_client.Job('fresh', 'fresh')
+            resumed.task_id, resumed.resumed = 'old', True
+            fresh.task_id = 'fresh'
+            for job in (resumed, fresh):
+                await in_queue.put(job)
+            await in_queue.put(cloud_client.STAGE_END)
+            await tracker.run(in_queue, out_queue, None, recreate)
+            return sorted(out_queue.get_nowait().task_id for _ in range(2))
+
+        # Only the resumed task is created again, a new task unknown to the API is polled again
+        self.assertListEqual(['fresh', 'new'], asyncio.run(track()))
+
+        tracker = client_api.TaskTracker(lambda task_id: 404, min_interval=0.01, max_interval=0.02, max_checks=2)
+        tracker.start()
+        self.assertEqual(404, tracker.track('old', resumed=True).result(timeout=5))
+        tracker.stop()
+
+
+class TestTokenManager(unittest.TestCase):
+    def test_renewal_before_expiration(self):
+        tokens = iter(['first', 'second', 'third'])
+        authenticate = Mock(side_effect=lambda: (next(tokens), 0.2))
+
+        token_manager = cloud_client.TokenManager(authenticate, renewal_margin=0.15)
+        token_manager.start()
+        self.assertEqual('first', token_manager.token)
+        # Renewed after half of the token lifetime, before expiration
+        time.sleep(0.15)
+        token_manager.stop()
+        self.assertEqual('second', token_manager.token)
+        self.assertEqual(2, authenticate.call_count)
+
+
+class TestTaskJournal(unittest.TestCase):
+    def test_resume_pending_tasks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'journal.sqlite')
+            journal = cloud_client.TaskJournal(path)
+            journal.record('a.jpg', 'task-a', cloud_client.TaskJournal.CREATED)
+            journal.record('a.jpg', 'task-a', cloud_client.TaskJournal.UPLOADED)
+            journal.record('b.jpg', 'task-b', cloud_client.TaskJournal.UPLOADED)
+            journal.record('b.jpg', 'task-b', cloud_client.TaskJournal.DONE)
+            journal.record('c.jpg', 'task-c', cloud_client.TaskJournal.CREATED)
+            journal.close()
+
+            journal = cloud_client.TaskJournal(path)
+            self.assertDictEqual({'a.jpg': 'task-a'}, journal.pending())
+            journal.close()
+
+    def test_commit_without_further_writes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'journal.sqlite')
+
+            def rows():
+                with contextlib.closing(sqlite3.connect(path)) as connection:
+                    return connection.execute('SELECT file_path, state FROM tasks').fetchall()
+
+            journal = cloud_client.TaskJournal(path)
+            # Uploaded tasks are committed right away, so they are never uploaded again after a crash
+            journal.record('a.jpg', 'task-a', cloud_client.TaskJournal.UPLOADED)
+            self.assertListEqual([('a.jpg', 'uploaded')], rows())
+            journal.close()
+
+            # Other changes are committed by the background thread, also without further writes
+            store = cloud_client.SqliteStore(path, [], commit_interval=0.05)
+            store.write('INSERT INTO tasks VALUES (?, ?, ?, ?)', ('b.jpg', 'task-b', cloud_client.TaskJournal.CREATED, 0.0))
+            time.sleep(0.5)
+            self.assertListEqual([('a.jpg', 'uploaded'), ('b.jpg', 'created')], sorted(rows()))
+            store.close()
+
+    def test_disabled_journal(self):
+        journal = cloud_client.TaskJournal()
+        journal.record('a.jpg', 'task-a', cloud_client.TaskJournal.UPLOADED)
+        self.assertDictEqual({}, journal.pending())
+
+
+class TestScanIndex(unittest.TestCase):
+    def test_incremental_scan(self):
+        with tempfile.TemporaryDirectory() as folder:
+            root = os.path.join(folder, 'input')
+            os.makedirs(os.path.join(root, 'sub'))
+            for file_path in ['a.jpg', 'b.txt', 'sub/c.png']:
+                open(os.path.join(root, file_path), 'wb').close()
+
+            index = cloud_client.ScanIndex(os.path.join(folder, 'index.sqlite'), scan_threads=2)
+            self.assertListEqual(['a.jpg', 'sub/c.png'], sorted(index.scan(root, client_api.EXTENSIONS, recursive=True)))
+            self.assertListEqual(['a.jpg'], sorted(index.scan(root, client_api.EXTENSIONS, recursive=False)))
+
+            index.mark_done('a.jpg')
+            open(os.path.join(root, 'sub', 'd.jpg'), 'wb').close()
+            self.assertListEqual(['sub/c.png', 'sub/d.jpg'], sorted(index.scan(root, client_api.EXTENSIONS, recursive=True)))
+            index.close()
+
+
+class TestResultCache(unittest.TestCase):
+    def test_cache_and_evict(self):
+        with tempfile.TemporaryDirectory() as folder:
+            def write(file_name, content):
+                path = os.path.join(folder, file_name)
+                with open(path, 'wb') as f:
+                    f.write(content)
+                return path
+
+            cache = cloud_client.ResultCache(os.path.join(folder, 'cache'), 10, {'face': True})
+            input_a, input_b = write('a.jpg', b'a'), write('b.jpg', b'b')
+            key_a, key_b = cache.key(input_a), cache.key(input_b)
+            self.assertNotEqual(key_a, cloud_client.ResultCache(os.path.join(folder, 'cache'), 10, {'face': False}).key(input_a))
+
+            output = os.path.join(folder, 'output', 'a.jpg')
+            self.assertFalse(cache.fetch(key_a, output))
+            cache.store(key_a, write('result-a.jpg', b'123456'))
+            self.assertTrue(cache.fetch(key_a, output))
+            with open(output, 'rb') as f:
+                self.assertEqual(b'123456', f.read())
+
+            # Exceeding the maximum size evicts the least recently used result
+            cache.store(key_b, write('result-b.jpg', b'7890123'))
+            self.assertFalse(cache.fetch(key_a, output))
+            self.assertTrue(cache.fetch(key_b, output))
+
+    def test_claim_in_flight_results(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache_folder = os.path.join(folder, 'cache')
+            cache = cloud_client.ResultCache(cache_folder, 100, {})
+            result = os.path.join(folder, 'result.jpg')
+            with open(result, 'wb') as f:
+                f.write(b'result')
+
+            # The first caller produces the result, later ones wait for it
+            self.assertIsNone(cache.claim('a'))
+            producing = cache.claim('a')
+            self.assertFalse(producing.done())
+            cache.store('a', result)
+            self.assertTrue(producing.done())
+            self.assertIsNone(cache.claim('a'))
+
+            # A producer giving up lets the next caller produce the result
+            self.assertIsNone(cache.claim('b'))
+            producing = cache.claim('b')
+            cache.release('b')
+            self.assertTrue(producing.done())
+            self.assertIsNone(cache.claim('b'))
+
+            # Files left over by an interrupted copy are removed instead of counted as results
+            with open(os.path.join(cache_folder, 'a' + 'b' * 63 + '.1234abcd.part'), 'wb') as f:
+                f.write(b'partial')
+            cache = cloud_client.ResultCache(cache_folder, 100, {})
+            self.assertListEqual(['a'], list(cache.entries))
+            self.assertEqual(len(b'result'), cache.size)
+            self.assertFalse(any(file_name.endswith('.part') for _, _, file_names in os.walk(cache_folder) for file_name in file_names))
+
+
+class TestAimdLimit(unittest.TestCase):
+    def test_increase_and_decrease(self):
+        limit = cloud_client.AimdLimit(initial=4, maximum=10, cooldown=60)
+        # Slow start: one more per success
+        for _ in range(4):
+            limit.success(0.1)
+        self.assertEqual(8, limit.limit)
+        # High latency does not increase the limit
+        limit.success(1.0)
+        self.assertEqual(8, limit.limit)
+
+        limit.throttled()
+        self.assertEqual(4, limit.limit)
+        # Within the cooldown, further throttling is ignored
+        limit.throttled()
+        self.assertEqual(4, limit.limit)
+        # Additive increase: one more per `limit` successes
+        for _ in range(4):
+            limit.success(0.1)
+        self.assertAlmostEqual(5, limit.limit, delta=0.1)
+
+        for _ in range(100):
+            limit.success(0.1)
+        self.assertEqual(10, limit.limit)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histograms_and_counters(self):
+        metrics = cloud_client.Metrics()
+        for seconds in (0.2, 0.3, 0.4, 4.0):
+            metrics.observe('upload', seconds)
+        metrics.increment('upload_bytes', 4900)
+        metrics.increment('retries')
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(4, snapshot['stages']['upload']['count'])
+        self.assertAlmostEqual(1000.0, snapshot['upload_bytes_per_second'])
+        self.assertDictEqual({'upload_bytes': 4900, 'retries': 1}, snapshot['counters'])
+        # Interpolated within the bucket bounds
+        self.assertTrue(0.25 <= metrics.quantile('upload', 0.5) <= 0.5)
+        self.assertTrue(2.5 <= metrics.quantile('upload', 0.99) <= 5.0)
+
+        text = metrics.prometheus()
+        self.assertIn('celantur_stage_duration_seconds_bucket{stage="upload",le="0.5"} 3', text)
+        self.assertIn('celantur_stage_duration_seconds_bucket{stage="upload",le="+Inf"} 4', text)
+        self.assertIn('celantur_retries_total 1', text)
+
+    def test_load_snapshots(self):
+        shards = [cloud_client.Metrics() for _ in range(2)]
+        for seconds, metrics in zip((0.2, 4.0), shards):
+            metrics.observe('download', seconds)
+            metrics.increment('completed')
+
+        total = cloud_client.Metrics()
+        total.load([metrics.snapshot() for metrics in shards])
+        snapshot = total.snapshot()
+        self.assertEqual(2, snapshot['counters']['completed'])
+        self.assertEqual(2, snapshot['stages']['download']['count'])
+        self.assertAlmostEqual(4.2, snapshot['stages']['download']['sum'])
+
+
+class TestShards(unittest.TestCase):
+    def test_partition(self):
+        paths = [f'folder/{i}.jpg' for i in range(100)]
+        shards = [[path for path in paths if client_api.shard_of(path, 4) == i] for i in range(4)]
+        # Every file is in exactly one shard
+        self.assertEqual(100, sum(len(shard) for shard in shards))
+        self.assertTrue(all(shards))
+        # Independent of the platform's path separator
+        self.assertEqual(client_api.shard_of('folder/0.jpg', 4), client_api.shard_of(os.path.join('folder', '0.jpg'), 4))
+
+    def test_shard_command_line(self):
+        argv = ['-i', 'in', '--journal', 'j.sqlite', '--metrics-port=9100', '--shard-index', '0', '1', '--shards', '4']
+        self.assertListEqual(['-i', 'in', '--shards', '4'],
+                             client_api.without_options(argv, ['--journal', '--metrics-port', '--shard-index']))
+        self.assertEqual('j.shard-2.sqlite', client_api.shard_file_path('j.sqlite', 2))
+
+    def test_number_of_shards(self):
+        argv = ['-i', 'in', '-o', 'out', '-u', 'user', '-p', 'password', '-c', 'configuration.json']
+        self.assertEqual(2, client_api.parser().parse_args(argv + ['--shards', '2']).shards)
+        with contextlib.redirect_stderr(None), self.assertRaises(SystemExit):
+            client_api.parser().parse_args(argv + ['--shards', '0'])
+
+
+@unittest.skipIf(cloud_client.np is None, "NumPy and OpenCV are not installed")
+class TestArrayCodec(unittest.TestCase):
+    def test_round_trip(self):
+        image = cloud_client.np.arange(4 * 5 * 3, dtype=cloud_client.np.uint8).reshape(4, 5, 3)
+        data = cloud_client.encode_image(image, '.png')
+        self.assertTrue(data.startswith(b'\x89PNG'))
+        self.assertTrue((image == cloud_client.decode_image(data)).all())
+        with self.assertRaises(ValueError):
+            cloud_client.decode_image(b'no image')
+
+
+class TestEndToEnd(unittest.TestCase):
+    def setUp(self):
+        self.server = mock_server.MockCelanturServer(processing_time=0.05, throttle_rate=0.2).start()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.folder.cleanup()
+
+    def run_script(self, engine: str, images: dict, *options: str, returncode: int = 0) -> str:
+        """
+        Anonymize the images (relative path -> content) with the script and return the output folder.
+
+        The outputs are only checked if the script exits with `returncode` 0.
+        """
+        input_folder = os.path.join(self.folder.name, 'input')
+        for path, data in images.items():
+            os.makedirs(os.path.dirname(os.path.join(input_folder, path)), exist_ok=True)
+            with open(os.path.join(input_folder, path), 'wb') as f:
+                f.write(data)
+        configuration_file = os.path.join(self.folder.name, 'configuration.json')
+        with open(configuration_file, 'w') as f:
+            f.write('{}')
+
+        output_folder = os.path.join(self.folder.name, engine)
+        process = subprocess.run([sys.executable, os.path.abspath(client_api.__file__), '-i', input_folder, '-o', output_folder,
+                        '-u', 'user', '-p', 'password', '-c', configuration_file, '-e', self.server.endpoint,
+                        '--engine', engine, '--number-threads', '3', '--poll-interval-min', '0.02', '--poll-interval-max', '0.05', *options],
+                       cwd=self.folder.name, capture_output=True)
+        self.assertEqual(returncode, process.returncode, process.stderr)
+        if returncode != 0:
+            return output_folder
+        for path, data in images.items():
+            with open(os.path.join(output_folder, path), 'rb') as f:
+                self.assertEqual(data, f.read())
+        return output_folder
+
+    def test_script(self):
+        images = {os.path.join('sub' if i % 2 else '', f'{i}.jpg'): os.urandom(1000) for i in range(6)}
+        for engine in ('threads', 'asyncio'):
+            self.run_script(engine, images)
+
+    def test_retry_failed_download(self):
+        self.server.throttle_rate = 0.0
+        self.server.failing_downloads = 2
+        images = {f'{i}.jpg': os.urandom(1000) for i in range(3)}
+        self.run_script('threads', images)
+        # Only the downloads were repeated, no task was created and uploaded again
+        self.assertEqual(len(images), len(self.server.tasks))
+
+    def test_cache_identical_images_in_flight(self):
+        self.server.throttle_rate = 0.0
+        images = {f'{i}.jpg': b'frame' for i in range(6)}
+        for engine in ('threads', 'asyncio'):
+            self.server.tasks.clear()
+            cache_folder = os.path.join(self.folder.name, f'{engine}-cache')
+            self.run_script(engine, images, '--cache-dir', cache_folder)
+            # Identical frames processed at the same time wait for the first one instead of creating their own task
+            self.assertEqual(1, len(self.server.tasks))
+
+    def test_resume_failed_task(self):
+        self.server.throttle_rate = 0.0
+        self.server.tasks['failed'] = {'uploaded': time.monotonic(), 'data': b'old'}
+        self.server.failed_tasks.add('failed')
+        images = {'a.jpg': b'image'}
+        for engine in ('threads', 'asyncio'):
+            journal_path = os.path.join(self.folder.name, f'{engine}.sqlite')
+            journal = cloud_client.TaskJournal(journal_path)
+            journal.record('a.jpg', 'failed', cloud_client.TaskJournal.UPLOADED)
+            journal.close()
+
+            # The failed task is recorded as failed, so the next run creates a new task instead of resuming it again
+            # Exits with an error because the file failed
+            self.run_script(engine, images, '--journal', journal_path, returncode=1)
+            journal = cloud_client.TaskJournal(journal_path)
+            self.assertDictEqual({}, journal.pending())
+            journal.close()
+            self.run_script(engine, images, '--journal', journal_path)
+
+    def test_failed_shard(self):
+        self.server.throttle_rate = 0.0
+        self.server.tasks['failed'] = {'uploaded': time.monotonic(), 'data': b'old'}
+        self.server.failed_tasks.add('failed')
+        journal_path = os.path.join(self.folder.name, 'journal.sqlite')
+        journal = cloud_client.TaskJournal(client_api.shard_file_path(journal_path, client_api.shard_of('a.jpg', 2)))
+        journal.record('a.jpg', 'failed', cloud_client.TaskJournal.UPLOADED)
+        journal.close()
+
+        # The shard process exits with an error although it did not crash, and so does the supervisor
+        self.run_script('threads', {'a.jpg': b'image', 'b.jpg': b'image'}, '--journal', journal_path, '--shards', '2',
+                        '--metrics-interval', '0.2', returncode=1)
+
+    @unittest.skipIf(cloud_client.aiohttp is None, "aiohttp is not installed")
+    def test_library(self):
+        async def submit():
+            async with cloud_client.CelanturCloudClient('user', 'password', {}, endpoint=self.server.endpoint, poll_interval_min=0.02) as client:
+                return [result async for result in client.submit_many([b'first', b'second', b'third'])]
+
+        results = sorted(asyncio.run(submit()), key=lambda result: result.index)
+        self.assertListEqual([True] * 3, [result.ok for result in results])
+        self.assertListEqual([b'first', b'second', b'third'], [result.data for result in results])
+
+    @unittest.skipIf(cloud_client.aiohttp is None, "aiohttp is not installed")
+    def test_library_output_paths(self):
+        input_folder = os.path.join(self.folder.name, 'input')
+        output_folder = os.path.join(self.folder.name, 'output')
+        files = [os.path.join(input_folder, folder, 'image.jpg') for folder in ('a', 'b')] + [os.path.join(self.folder.name, 'outside.jpg')]
+        for file_path in files:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                f.write(file_path.encode())
+
+        async def submit():
+            async with cloud_client.CelanturCloudClient('user', 'password', {}, endpoint=self.server.endpoint, poll_interval_min=0.02) as client:
+                return [result async for result in client.submit_many(files, output_folder, input_folder)]
+
+        results = sorted(asyncio.run(submit()), key=lambda result: result.index)
+        # Files with the same name in different folders keep their relative paths
+        self.assertListEqual([True, True, False], [result.ok for result in results])
+        for file_path, result in zip(files, results[:2]):
+            self.assertEqual(os.path.join(output_folder, os.path.relpath(file_path, input_folder)), result.output_path)
+            with open(result.output_path, 'rb') as f:
+                self.assertEqual(file_path.encode(), f.read())
+
+    @unittest.skipIf(cloud_client.aiohttp is None, "aiohttp is not installed")
+    def test_retry_streamed_upload(self):
+        self.server.throttle_rate = 0.0
+        self.server.failing_uploads = 1
+        input_file = os.path.join(self.folder.name, 'image.jpg')
+        with open(input_file, 'wb') as f:
+            f.write(b'image')
+
+        async def submit():
+            async with cloud_client.CelanturCloudClient('user', 'password', {}, endpoint=self.server.endpoint, poll_interval_min=0.02) as client:
+                return [result async for result in client.submit_many([input_file])]
+
+        retries = cloud_client.METRICS.counters['retries']
+        results = asyncio.run(submit())
+        self.assertTrue(results[0].ok)
+        self.assertEqual(b'image', results[0].data)
+        self.assertEqual(0, self.server.failing_uploads)
+        # The file is sent again by the HTTP retry, the upload stage itself did not fail
+        self.assertEqual(retries, cloud_client.METRICS.counters['retries'])
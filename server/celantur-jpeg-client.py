@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
 import socket
+import threading
 from datetime import datetime
+from queue import Queue
 import PIL.Image
 import argparse
 
@@ -10,25 +12,100 @@ parser.add_argument("-i", "--input", help="Input directory.", required=True)
 parser.add_argument("-o", "--output", help="Output directory.", required=True)
 parser.add_argument("--host", help="Host address", default="localhost")
 parser.add_argument("--port", help="Port number", type=int, default=9999)
+parser.add_argument("--connections", help="Number of images sent at the same time, each over its own connection",
+                    type=int, default=4)
+parser.add_argument("--recursive", help="Recursively go through the input directory",
+                    action=argparse.BooleanOptionalAction, default=True)
+parser.add_argument("--overwrite", help="Process images again whose output already exists", action="store_true")
+parser.add_argument("--chunk-size", help="Bytes received at once while writing the response to disk",
+                    type=int, default=256 * 1024)
 args = parser.parse_args()
 
-for filename in os.listdir(args.input):
-    if os.path.splitext(filename)[1].lower() in [".jpeg", ".jpg"]:
-        file = os.path.join(args.input, filename)
-        now = datetime.now
-        size = os.path.getsize(file)
-        print(f"File size of {file}: {size} bytes")
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((args.host, args.port))
-            with open(file, "rb") as fp:
-                r = s.sendfile(fp)
-                print(f"{now().strftime('%H:%M:%S,%f')} - Sent {r} bytes to server.")
-            s.shutdown(socket.SHUT_WR)
-            output_buffer = s.makefile('rb')
-            output_file = os.path.join(args.output, filename)
-            print(f"{now().strftime('%H:%M:%S,%f')} - Save image to {output_file}.")
-            with open(output_file, "wb") as f:
-                f.write(output_buffer.read())
-
-print("DONE")
+now = datetime.now
+
+
+def input_files():
+    """
+    Relative paths of the JPEG files to process, without those whose output exists unless --overwrite
+    """
+    for root, dirs, files in os.walk(args.input):
+        if not args.recursive:
+            dirs.clear()
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() not in [".jpeg", ".jpg"]:
+                continue
+            path = os.path.relpath(os.path.join(root, filename), args.input)
+            if not args.overwrite and os.path.exists(os.path.join(args.output, path)):
+                print(f"Skip {path}, output exists.")
+                continue
+            yield path
+
+
+def process_file(path: str, buffer: memoryview):
+    """
+    Send the file and stream the response to disk, the output only appears once it is complete
+    """
+    file = os.path.join(args.input, path)
+    output_file = os.path.join(args.output, path)
+    partial_file = output_file + ".part"
+    size = os.path.getsize(file)
+    print(f"File size of {file}: {size} bytes")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect((args.host, args.port))
+        with open(file, "rb") as fp:
+            r = s.sendfile(fp)
+            print(f"{now().strftime('%H:%M:%S,%f')} - Sent {r} bytes to server.")
+        s.shutdown(socket.SHUT_WR)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        print(f"{now().strftime('%H:%M:%S,%f')} - Save image to {output_file}.")
+        received = 0
+        try:
+            with open(partial_file, "wb") as f:
+                while n := s.recv_into(buffer):
+                    f.write(buffer[:n])
+                    received += n
+            if received == 0:
+                raise ValueError(f"Received 0 bytes from Celantur Container for {file}!")
+            os.replace(partial_file, output_file)
+        except BaseException:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+            raise
+    print(f"{now().strftime('%H:%M:%S,%f')} - Received {received} bytes for {file}.")
+
+
+def process_files():
+    """
+    Process the files over --connections connections at the same time while the input is scanned
+    """
+    files = Queue(maxsize=2 * args.connections)
+    failed = []
+
+    def work():
+        # One receive buffer per connection, reused for all files
+        buffer = memoryview(bytearray(args.chunk_size))
+        while (path := files.get()) is not None:
+            try:
+                process_file(path, buffer)
+            except (OSError, ValueError) as e:
+                print(f"{now().strftime('%H:%M:%S,%f')} - Failed to process {path}: {e!r}")
+                failed.append(path)
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(args.connections)]
+    for worker in workers:
+        worker.start()
+    for path in input_files():
+        files.put(path)
+    for _ in workers:
+        files.put(None)
+    for worker in workers:
+        worker.join()
+    if failed:
+        raise SystemExit(f"Failed to process {len(failed)} images: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    process_files()
+    print("DONE")
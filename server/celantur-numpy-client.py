@@ -6,6 +6,12 @@ import numpy as np
 from io import BytesIO
 import argparse
 import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from queue import Queue
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("-i", "--input", help="Input directory.", required=True)
@@ -14,36 +20,124 @@ parser.add_argument("--host", help="Host address", default="localhost")
 parser.add_argument("--port", help="Port number", type=int, default=9999)
 parser.add_argument("--buffer-size", help="Buffer size in bytes. Use the same buffer size as the server!",
                     type=int, default=4096)
+parser.add_argument("--protocol", choices=["legacy", "framed"], default="legacy",
+                    help="legacy: one connection per image. framed: length-prefixed frames with request IDs over "
+                         "persistent connections, requires a server supporting it.")
+parser.add_argument("--connections", help="Number of persistent connections (framed protocol)", type=int, default=2)
+parser.add_argument("--in-flight", help="Images in flight per connection (framed protocol)", type=int, default=4)
+parser.add_argument("--retries", help="Times an image is sent again over a new connection after its connection was "
+                                      "lost (framed protocol)", type=int, default=5)
+parser.add_argument("--format", choices=["npy", "raw"], default="npy",
+                    help="Payload of the framed protocol. npy: .npy file. raw: pixels after a compact header "
+                         "with dtype and shape, sent without copying the array, requires --protocol framed.")
+parser.add_argument("--pipeline", action="store_true",
+                    help="Decode, send and encode images concurrently, each step with its own pool of threads.")
+parser.add_argument("--decode-workers", help="Threads reading and decoding images (pipeline)", type=int,
+                    default=os.cpu_count())
+parser.add_argument("--workers", help="Threads sending images to the container (pipeline)", type=int, default=4)
+parser.add_argument("--encode-workers", help="Threads encoding and writing images (pipeline)", type=int,
+                    default=os.cpu_count())
+parser.add_argument("--queue-depth", help="Maximum number of images waiting between the steps (pipeline)",
+                    type=int, default=16)
 args = parser.parse_args()
+if args.format == "raw" and args.protocol != "framed":
+    parser.error("--format raw requires --protocol framed")
 
 now = datetime.now
 
 
+class BufferPool:
+    """
+    Reusable receive buffers, so streaming images does not allocate memory for every frame.
+
+    Arrays received into a buffer are views on it, the buffer is reused after `release` of the array.
+    """
+
+    def __init__(self, max_buffers: int = 16):
+        self.max_buffers = max_buffers
+        self.buffers = []
+        self.lock = threading.Lock()
+
+    def get(self, size: int) -> memoryview:
+        with self.lock:
+            for i, buffer in enumerate(self.buffers):
+                if len(buffer) >= size:
+                    return memoryview(self.buffers.pop(i))[:size]
+        return memoryview(bytearray(size))[:size]
+
+    def release(self, array: np.ndarray):
+        base = array
+        while isinstance(base, np.ndarray):
+            base = base.base
+        if isinstance(base, memoryview) and isinstance(base.obj, bytearray):
+            with self.lock:
+                if len(self.buffers) < self.max_buffers:
+                    self.buffers.append(base.obj)
+
+
+RECEIVE_BUFFERS = BufferPool()
+
+
+def recv_into_buffer(connection: socket.socket, buffer: memoryview) -> int:
+    """
+    Fill the buffer from the connection, returns the number of bytes received before the connection was closed
+    """
+    received = 0
+    while received < len(buffer):
+        n = connection.recv_into(buffer[received:])
+        if n == 0:
+            break
+        received += n
+    return received
+
+
+def array_from_npy(content: memoryview) -> np.ndarray:
+    """
+    Array of a .npy file in memory, as view on the memory instead of a copy like np.load
+    """
+    major_version = content[6]
+    header_length_size = 2 if major_version == 1 else 4
+    data_offset = 8 + header_length_size + int.from_bytes(content[8:8 + header_length_size], "little")
+    with BytesIO(content[:data_offset]) as fp:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    # Like np.load(allow_pickle=False)
+    if dtype.hasobject:
+        raise ValueError("Object arrays cannot be loaded without pickle")
+    array = np.frombuffer(content, dtype=dtype, count=int(np.prod(shape)), offset=data_offset)
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
 def send_image(connection: socket.socket, image: np.ndarray):
     with BytesIO() as fp:
         # Disable pickle for security, cf https://numpy.org/doc/stable/reference/generated/numpy.load.html
         np.save(fp, image, allow_pickle=False)
-        fp.flush()
-        content = fp.getvalue()
-    filesize = len(content)
-    content = filesize.to_bytes(args.buffer_size, "big") + content
-    connection.sendall(content)
+        # Header and file straight from the memory of fp, without copying the file
+        with fp.getbuffer() as content:
+            filesize = len(content)
+            send_buffers(connection, [filesize.to_bytes(args.buffer_size, "big"), content])
     print(f"{now().strftime('%H:%M:%S,%f')} - Sent {filesize} bytes.")
 
 
 def receive_image(connection: socket.socket) -> np.ndarray:
-    header = connection.recv(args.buffer_size)
+    """
+    Receive the image straight into a reusable buffer, release it with `RECEIVE_BUFFERS.release(image)`
+    """
+    header = bytearray(args.buffer_size)
+    recv_into_buffer(connection, memoryview(header))
     filesize = int.from_bytes(header, "big")
-    content = bytearray()
-    while len(content) < filesize:
-        content += connection.recv(args.buffer_size)
-    if len(content) == 0:
+    content = RECEIVE_BUFFERS.get(filesize)
+    received = recv_into_buffer(connection, content)
+    if received == 0:
         raise ValueError("Received 0 bytes from Celantur Container!")
+    elif received < filesize:
+        raise ValueError(f"Received {received} of {filesize} bytes from Celantur Container!")
     else:
-        print(f"{now().strftime('%H:%M:%S,%f')} - Received {len(content)} bytes.")
-    with BytesIO(content) as fp:
-        array = np.load(fp, allow_pickle=False)
-    return array
+        print(f"{now().strftime('%H:%M:%S,%f')} - Received {received} bytes.")
+    return array_from_npy(content)
 
 
 def process_image(image: np.ndarray, trial=0) -> np.ndarray:
@@ -62,17 +156,333 @@ def process_image(image: np.ndarray, trial=0) -> np.ndarray:
             raise e
 
 
+# Frame of the framed protocol: payload length, request ID, payload
+FRAME_HEADER = struct.Struct("!IQ")
+# Raw payload: dtype (numpy dtype string, e.g. "|u1"), number of dimensions, up to 3 dimensions, pixels
+RAW_HEADER = struct.Struct("!8sB3I")
+
+
+def raw_payload(image: np.ndarray) -> list:
+    """
+    Buffers of the raw payload, the pixels are sent from the memory of the array itself
+    """
+    image = np.ascontiguousarray(image)
+    shape = image.shape + (1,) * (3 - image.ndim)
+    header = RAW_HEADER.pack(image.dtype.str.encode(), image.ndim, *shape)
+    return [header, memoryview(image).cast("B")]
+
+
+def from_raw_payload(content: memoryview) -> np.ndarray:
+    dtype, ndim, *shape = RAW_HEADER.unpack_from(content)
+    # A view on the received buffer, no copy
+    pixels = np.frombuffer(content, dtype=np.dtype(dtype.rstrip(b"\0").decode()), offset=RAW_HEADER.size)
+    return pixels.reshape(shape[:ndim])
+
+
+def send_buffers(connection: socket.socket, buffers: list):
+    """
+    Send the buffers with as few system calls and copies as possible (scatter/gather I/O)
+    """
+    if not hasattr(connection, "sendmsg"):  # Windows
+        for buffer in buffers:
+            connection.sendall(buffer)
+        return
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+    while buffers:
+        sent = connection.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+class ConnectionClosedError(ConnectionError):
+    """
+    The framed connection is closed, no more requests can be sent over it
+    """
+
+
+class FramedConnection:
+    """
+    Persistent connection exchanging length-prefixed frames with request IDs.
+
+    Up to `in_flight` requests are sent without waiting for their responses, which are matched
+    to the requests by their ID in whatever order the server answers. Once the connection failed, its
+    pending requests fail with a `ConnectionError` and new requests with a `ConnectionClosedError`.
+    """
+
+    def __init__(self, host: str, port: int, in_flight: int):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()  # Guards pending and closed
+        self.pending = {}  # request ID -> Future of the response payload
+        self.closed = False
+        self.slots = threading.Semaphore(in_flight)
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def submit(self, request_id: int, payload: list) -> Future:
+        """
+        Send the payload, given as list of buffers, and return the future of the response payload
+        """
+        self.slots.acquire()
+        future = Future()
+        with self.lock:
+            if self.closed:
+                self.slots.release()
+                raise ConnectionClosedError("Connection to Celantur Container is closed!")
+            self.pending[request_id] = future
+        size = sum(memoryview(buffer).nbytes for buffer in payload)
+        try:
+            with self.send_lock:
+                send_buffers(self.socket, [FRAME_HEADER.pack(size, request_id), *payload])
+        except OSError as e:
+            self.fail(e)
+        return future
+
+    def receive(self):
+        header = memoryview(bytearray(FRAME_HEADER.size))
+        try:
+            while True:
+                if recv_into_buffer(self.socket, header) < FRAME_HEADER.size:
+                    raise ConnectionError("Connection closed by Celantur Container!")
+                size, request_id = FRAME_HEADER.unpack(header)
+                payload = RECEIVE_BUFFERS.get(size)
+                if recv_into_buffer(self.socket, payload) < size:
+                    raise ConnectionError("Connection closed by Celantur Container!")
+                with self.lock:
+                    future = self.pending.pop(request_id)
+                future.set_result(payload)
+                self.slots.release()
+        except (OSError, KeyError, struct.error) as e:
+            self.fail(e)
+
+    def fail(self, error: BaseException):
+        """
+        Close the connection and fail its pending requests, which frees their slots for waiting senders
+        """
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionError(f"Connection to Celantur Container failed: {error!r}"))
+            self.slots.release()
+        try:
+            # Wakes up the receiver, unlike close()
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.fail(ConnectionClosedError("Connection closed by client"))
+        self.socket.close()
+
+
+class FramedClient:
+    """
+    Pool of persistent connections, images are distributed round-robin over the connections.
+
+    A lost connection is replaced by a new one, and the images in flight on it are sent again up to `retries` times.
+    """
+
+    def __init__(self, host: str, port: int, connections: int, in_flight: int, payload_format: str = "npy",
+                 retries: int = 5):
+        self.host = host
+        self.port = port
+        self.in_flight = in_flight
+        self.connections = [FramedConnection(host, port, in_flight) for _ in range(connections)]
+        self.lock = threading.Lock()  # Guards connections and closed
+        self.closed = False
+        self.request_ids = count()
+        self.payload_format = payload_format
+        self.retries = retries
+
+    def submit(self, image: np.ndarray) -> Future:
+        if self.payload_format == "raw":
+            payload = raw_payload(image)
+        else:
+            fp = BytesIO()
+            np.save(fp, image, allow_pickle=False)
+            payload = [fp.getbuffer()]  # No copy unlike getvalue()
+        response = Future()
+        self.send(payload, response)
+        return response
+
+    def send(self, payload: list, response: Future, trial: int = 0):
+        """
+        Send the payload and complete `response` with the response payload, sending it again on connection errors
+        """
+        request_id = next(self.request_ids)
+        size = sum(memoryview(buffer).nbytes for buffer in payload)
+        print(f"{now().strftime('%H:%M:%S,%f')} - Send {size} bytes as request {request_id}.")
+        try:
+            future = self.connection(request_id).submit(request_id, payload)
+        except OSError as e:
+            future = Future()
+            future.set_exception(e)
+
+        def done(future: Future):
+            error = future.exception()
+            if error is None:
+                response.set_result(future.result())
+            elif trial < self.retries and not self.closed:
+                print(f"{now().strftime('%H:%M:%S,%f')} - Request {request_id} failed, sending it again: {error!r}")
+                # Not in the receiver thread of the failed connection, sending can block
+                threading.Thread(target=self.send, args=(payload, response, trial + 1), daemon=True).start()
+            else:
+                response.set_exception(error)
+
+        future.add_done_callback(done)
+
+    def connection(self, request_id: int) -> FramedConnection:
+        """
+        Connection of the request, a closed connection is replaced by a new one
+        """
+        index = request_id % len(self.connections)
+        with self.lock:
+            if self.closed:
+                raise ConnectionClosedError("Client is closed!")
+            if self.connections[index].closed:
+                print(f"{now().strftime('%H:%M:%S,%f')} - Reconnect to Celantur Container.")
+                self.connections[index].close()
+                self.connections[index] = FramedConnection(self.host, self.port, self.in_flight)
+            return self.connections[index]
+
+    def decode(self, content: memoryview) -> np.ndarray:
+        """
+        Image of a response payload, a view on the receive buffer until `RECEIVE_BUFFERS.release(image)`
+        """
+        print(f"{now().strftime('%H:%M:%S,%f')} - Received {len(content)} bytes.")
+        if self.payload_format == "raw":
+            return from_raw_payload(content)
+        return array_from_npy(content)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        for connection in self.connections:
+            connection.close()
+
+
+def input_files() -> list:
+    return [filename for filename in os.listdir(args.input)
+            if os.path.splitext(filename)[1].lower() in [".png", ".jpeg", ".jpg"]]
+
+
+def save_image(filename: str, image: np.ndarray):
+    OUTPUT = os.path.join(args.output, filename)
+    print(f"{now().strftime('%H:%M:%S,%f')} - Save image to {OUTPUT}.")
+    cv2.imwrite(OUTPUT, image)
+    RECEIVE_BUFFERS.release(image)
+    print(f"{now().strftime('%H:%M:%S,%f')} - DONE")
+
+
+def process_images_framed():
+    """
+    Keep up to connections * in-flight images in the pipeline, results are saved in input order
+    """
+    client = FramedClient(args.host, args.port, args.connections, args.in_flight, args.format, args.retries)
+    in_flight = deque()
+    try:
+        for filename in input_files():
+            INPUT = os.path.join(args.input, filename)
+            print(f"{now().strftime('%H:%M:%S,%f')} - Load image {INPUT}.")
+            in_flight.append((filename, client.submit(cv2.imread(INPUT))))
+            if len(in_flight) >= args.connections * args.in_flight:
+                filename, response = in_flight.popleft()
+                save_image(filename, client.decode(response.result()))
+        while in_flight:
+            filename, response = in_flight.popleft()
+            save_image(filename, client.decode(response.result()))
+    finally:
+        client.close()
+
+
+def process_images_pipelined():
+    """
+    Decode, process and encode images at the same time, images are saved in the order they are done.
+
+    OpenCV and socket I/O release the GIL, so the threads of the steps use all cores while the container
+    processes. The queues between the steps hold up to --queue-depth images, which bounds the memory.
+    """
+    client = None
+    if args.protocol == "framed":
+        client = FramedClient(args.host, args.port, args.connections, args.in_flight, args.format, args.retries)
+    # Images in flight can keep their receive buffer until they are saved
+    RECEIVE_BUFFERS.max_buffers = max(RECEIVE_BUFFERS.max_buffers, 2 * args.queue_depth + args.workers)
+    failed = []
+
+    def decode(filename: str) -> tuple:
+        INPUT = os.path.join(args.input, filename)
+        print(f"{now().strftime('%H:%M:%S,%f')} - Load image {INPUT}.")
+        image = cv2.imread(INPUT)
+        if image is None:
+            raise ValueError(f"Cannot read image {INPUT}")
+        return filename, image
+
+    def process(item: tuple) -> tuple:
+        filename, image = item
+        if client is None:
+            return filename, process_image(image)
+        return filename, client.decode(client.submit(image).result())
+
+    def encode(item: tuple):
+        save_image(*item)
+
+    def work(step, source: Queue, sink: Queue):
+        # Stops at None
+        while (item := source.get()) is not None:
+            try:
+                result = step(item)
+            except Exception as e:
+                filename = item if isinstance(item, str) else item[0]
+                print(f"{now().strftime('%H:%M:%S,%f')} - Failed to process {filename}: {e!r}")
+                failed.append(filename)
+                continue
+            if sink is not None:
+                sink.put(result)
+
+    filenames = Queue()
+    for filename in input_files():
+        filenames.put(filename)
+    queues = [filenames, Queue(maxsize=args.queue_depth), Queue(maxsize=args.queue_depth), None]
+    steps = [(decode, args.decode_workers), (process, args.workers), (encode, args.encode_workers)]
+    pools = []
+    for i, (step, workers) in enumerate(steps):
+        pool = [threading.Thread(target=work, args=(step, queues[i], queues[i + 1]), daemon=True)
+                for _ in range(workers)]
+        for thread in pool:
+            thread.start()
+        pools.append(pool)
+    try:
+        # Stop each step once the previous one is finished
+        for pool, queue in zip(pools, queues):
+            for _ in pool:
+                queue.put(None)
+            for thread in pool:
+                thread.join()
+    finally:
+        if client is not None:
+            client.close()
+    if failed:
+        raise SystemExit(f"Failed to process {len(failed)} images: {', '.join(failed)}")
+
+
 if __name__ == "__main__":
 
-    for filename in os.listdir(args.input):
-        if os.path.splitext(filename)[1].lower() in [".png", ".jpeg", ".jpg"]:
+    if args.pipeline:
+        process_images_pipelined()
+    elif args.protocol == "framed":
+        process_images_framed()
+    else:
+        for filename in input_files():
             INPUT = os.path.join(args.input, filename)
-            OUTPUT = os.path.join(args.output, filename)
             print(f"{now().strftime('%H:%M:%S,%f')} - Load image {INPUT}.")
             orig_image = cv2.imread(os.path.join(args.input, filename))
             # print(f"Iteration {filename}:".upper())
             image = process_image(orig_image)
-            print(f"{now().strftime('%H:%M:%S,%f')} - Save image to {OUTPUT}.")
-            cv2.imwrite(OUTPUT, image)
-            print(f"{now().strftime('%H:%M:%S,%f')} - DONE")
+            save_image(filename, image)
 
@@ -1,14 +1,15 @@
 #!/bin/env python3
 import logging
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from logging import getLevelName
 from os import makedirs
 from os.path import join, basename
 from sys import argv
-from time import sleep
+from time import monotonic
 
 from snippets.v1_get_anonymized_image import v1_get_anonymized_image
-from snippets.v1_get_task import v1_get_task
+from snippets.v1_get_tasks import create_session, v1_get_tasks
 from snippets.v1_upload_async import v1_upload_async
 
 
@@ -24,57 +25,131 @@ def log_details(host: str, port: int, folder: str, files: list, level: str):
     logging.info("## Download folder: %s", folder)
 
 
-def upload_async_files(host: str, port: int, files: list, params: dict, mime_type):
+def upload_async_files(host: str, port: int, files: list, params: dict, mime_type, parallel_uploads: int, requested_task_files: dict):
     """
-    Async upload files
-    """
-    requested_task_files = {}
-
-    # First uploading all the files with a single loop
-    logging.info(">> Uploading files")
-    for file_path in files:
+    Async upload files, `parallel_uploads` at a time in background threads
 
+    The task uid of each file is added to `requested_task_files` as soon as its upload finished,
+    so the anonymized files can be downloaded while the remaining files are still uploading.
+    Returns the futures of the uploads.
+    """
+    def upload(file_path):
         # Performing async upload, and obtaining task uid
-        uid = v1_upload_async(host, port, file_path, params, mime_type)
+        try:
+            uid = v1_upload_async(host, port, file_path, params, mime_type)
+        except Exception as e:
+            logging.error("Upload of %s failed: %s", file_path, e)
+            raise
 
         if not uid:
             raise Exception("Task couldn't have been found")
         requested_task_files[uid] = file_path
+        logging.info(">> Uploaded %s as task %s", file_path, uid)
+        return uid
 
-    return requested_task_files
+    logging.info(">> Uploading files")
+    executor = ThreadPoolExecutor(max_workers=parallel_uploads, thread_name_prefix="upload")
+    uploads = [executor.submit(upload, file_path) for file_path in files]
+    executor.shutdown(wait=False)
+    return uploads
 
 
-def download_async_anonymized_files(host: str, port: int, folder: str, requested_task_files: dict, polling_retry_sec: int):
+def download_async_anonymized_files(host: str, port: int, folder: str, requested_task_files: dict, polling_retry_sec: float,
+                                    uploads: list = (), max_polling_retry_sec: float = 30, parallel_downloads: int = 8,
+                                    backoff: float = 1.5, download_attempts: int = 3):
     """
     Async download anonymized files
+
+    Tasks are polled as soon as their upload in `uploads` finished, or right away if they are already in
+    `requested_task_files`. Only pending tasks are polled, with one request for all due tasks if the container
+    supports it, so the cost of a polling round grows with the outstanding tasks instead of the batch size.
+    Finished tasks are downloaded in the background, `parallel_downloads` at a time, while the polling goes on,
+    and the finished downloads are collected in the next round. A task whose download failed is polled again,
+    after `download_attempts` failed downloads it counts as failed. The polling interval of each task
+    grows by `backoff` from `polling_retry_sec` up to `max_polling_retry_sec`, which saves requests on long
+    running tasks.
+    Returns the number of files that failed to upload or anonymize.
     """
-    processed_task_uids = []
-    failed_task_uids = []
+    pending = {}  # uid -> (time of next poll, polling interval)
+    processed_task_uids = set()
+    failed_task_uids = set()
+    failed_uploads = 0
+    downloading = {}  # uid -> (download future, polling interval)
+    download_failures = {}  # uid -> number of failed downloads
+    remaining_uploads = list(uploads)
+
+    def add_pending(uid):
+        if uid not in pending and uid not in processed_task_uids and uid not in failed_task_uids:
+            pending[uid] = (monotonic() + polling_retry_sec, polling_retry_sec)
+
+    def download(uid):
+        try:
+            anonymized_file_path = join(folder, basename(requested_task_files[uid]))
+            v1_get_anonymized_image(host, port, uid, output_path=anonymized_file_path)
+            logging.info("<< Anonymized file downloaded to %s", anonymized_file_path)
+            return True
+        except Exception as e:
+            logging.error("Downloading task %s failed: %s", uid, e)
+            return False
+
+    for uid in list(requested_task_files):
+        add_pending(uid)
 
-    # Second checking the status and download processed ones
     logging.info("Downloading anonymized files...")
-    while len(processed_task_uids + failed_task_uids) != len(requested_task_files):
-        for uid, file_path in requested_task_files.items():
-            # Getting task to check the status
-            if task := v1_get_task(host, port, uid):
-                if task["status"] == "done":
-                    processed_task_uids.append(uid)
-
-                    anonymized_file_blob = v1_get_anonymized_image(host, port, uid)
-                    anonymized_file_path = join(folder, basename(file_path))
-
-                    with open(anonymized_file_path, "wb") as fd:
-                        fd.write(anonymized_file_blob)
-
-                    logging.info("<< Anonymized file downloaded to %s", anonymized_file_path)
-
-                elif task["status"] in ("failed", "deleted"):
-                    failed_task_uids.append(uid)
+    session = create_session(parallel_downloads)
+    with ThreadPoolExecutor(max_workers=parallel_downloads, thread_name_prefix="download") as executor:
+        while True:
+            uploading = []
+            for upload in remaining_uploads:
+                if not upload.done():
+                    uploading.append(upload)
+                elif upload.exception() is None:
+                    add_pending(upload.result())
+                else:
+                    failed_uploads += 1
+            remaining_uploads = uploading
+            for uid, (download_future, interval) in list(downloading.items()):
+                if not download_future.done():
+                    continue
+                del downloading[uid]
+                if download_future.result():
+                    processed_task_uids.add(uid)
+                    continue
+                download_failures[uid] = download_failures.get(uid, 0) + 1
+                if download_failures[uid] >= download_attempts:
+                    failed_task_uids.add(uid)
+                    logging.error("Downloading task %s failed %s times, giving up", uid, download_failures[uid])
+                else:
+                    interval = min(interval * backoff, max_polling_retry_sec)
+                    pending[uid] = (monotonic() + interval, interval)
+            if not pending and not remaining_uploads and not downloading:
+                break
+
+            now = monotonic()
+            due = [uid for uid, (next_poll, _) in pending.items() if next_poll <= now]
+            tasks = v1_get_tasks(host, port, due, session=session, parallel_requests=parallel_downloads) if due else {}
+            for uid, task in tasks.items():
+                if task and task["status"] == "done":
+                    downloading[uid] = (executor.submit(download, uid), pending.pop(uid)[1])
+                elif task and task["status"] in ("failed", "deleted"):
+                    failed_task_uids.add(uid)
+                    del pending[uid]
                     logging.error("Task %s failed", uid)
+                else:
+                    interval = min(pending[uid][1] * backoff, max_polling_retry_sec)
+                    pending[uid] = (monotonic() + interval, interval)
 
-        logging.debug("Polling anonymized image. Retry in %s seconds", polling_retry_sec)
+            # Wait until the next task is due or an upload or download finished
+            next_poll = min((next_poll for next_poll, _ in pending.values()), default=monotonic() + polling_retry_sec)
+            logging.debug("Polling anonymized images. %s pending, %s downloading, next poll in %.1f seconds",
+                          len(pending), len(downloading), next_poll - monotonic())
+            wait([*remaining_uploads, *(download_future for download_future, _ in downloading.values())],
+                 timeout=max(next_poll - monotonic(), 0), return_when=FIRST_COMPLETED)
 
-        sleep(polling_retry_sec)
+    session.close()
+    failed = len(failed_task_uids) + failed_uploads
+    logging.info("%s files anonymized, %s failed", len(processed_task_uids), failed)
+    return failed
 
 
 def main(files: list, params: dict, mime_type):
@@ -84,7 +159,11 @@ def main(files: list, params: dict, mime_type):
     folder = os.environ.get("CELANTUR_DOWNLOAD_DIR") or join("/tmp", "celantur")
     host = os.environ.get("CELANTUR_HOST") or "127.0.0.1"
     port = os.environ.get("CELANTUR_PORT") or 7000
-    polling_retry_sec = os.environ.get("CELANTUR_POLLING_RETRY") or 3
+    polling_retry_sec = float(os.environ.get("CELANTUR_POLLING_RETRY") or 3)
+    max_polling_retry_sec = float(os.environ.get("CELANTUR_MAX_POLLING_RETRY") or 30)
+    parallel_uploads = int(os.environ.get("CELANTUR_PARALLEL_UPLOADS") or 4)
+    parallel_downloads = int(os.environ.get("CELANTUR_PARALLEL_DOWNLOADS") or 8)
+    download_attempts = int(os.environ.get("CELANTUR_DOWNLOAD_ATTEMPTS") or 3)
     debug_level = getLevelName(os.environ.get("CELANTUR_DEBUG_LEVEL") or "INFO")
 
     makedirs(folder, exist_ok=True)
@@ -92,11 +171,16 @@ def main(files: list, params: dict, mime_type):
     # Logging details about run
     log_details(host, port, folder, files, debug_level)
 
-    # Uploading files asynchronously
-    requested_task_files = upload_async_files(host, port, files, params, mime_type)
-
-    # Downloading files asynchronously through polling
-    download_async_anonymized_files(host, port, folder, requested_task_files, polling_retry_sec)
+    # Uploading files asynchronously in the background
+    requested_task_files = {}
+    uploads = upload_async_files(host, port, files, params, mime_type, parallel_uploads, requested_task_files)
+
+    # Downloading files asynchronously through polling, overlapping with the remaining uploads
+    failed = download_async_anonymized_files(host, port, folder, requested_task_files, polling_retry_sec, uploads,
+                                             max_polling_retry_sec, parallel_downloads,
+                                             download_attempts=download_attempts)
+    if failed:
+        raise SystemExit(f"{failed} of {len(files)} files failed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import os
+import uuid
+from contextlib import suppress
+
+
+def stream_to_file(resp, file_path, chunk_size=1024 * 1024):
+    """
+    Write a streamed response to disk chunk by chunk
+
+    The content goes to a temporary file next to `file_path` which is renamed
+    once the download is complete, so an interrupted download never leaves a
+    truncated file behind.
+    """
+    folder, file_name = os.path.split(file_path)
+    temporary_path = os.path.join(folder, f".{file_name}.{uuid.uuid4().hex[:8]}.part")
+
+    try:
+        with open(temporary_path, "xb") as fd:
+            for chunk in resp.iter_content(chunk_size):
+                fd.write(chunk)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+
+    return file_path
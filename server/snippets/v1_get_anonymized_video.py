@@ -2,20 +2,29 @@ import logging
 
 import requests
 
+from snippets.stream_to_file import stream_to_file
 
-def v1_get_anonymized_video(host, port, uid, scheme="http"):
+
+def v1_get_anonymized_video(host, port, uid, scheme="http", output_path=None):
     """
     Getting anonymized video
+
+    If `output_path` is given, the video is streamed to that file and the path
+    is returned instead of the content.
     """
     url = f"{scheme}://{host}:{port}"
     endpoint = f"v1/file/{uid}/video/anonymised"
 
     resp = requests.get(
         f"{url}/{endpoint}",
+        stream=output_path is not None,
     )
 
     logging.info("Received response (%s) for \"%s\"", resp.status_code, f"/{endpoint}")
     if 200 <= resp.status_code < 400:
-        return resp.content
+        if output_path is None:
+            return resp.content
+        with resp:
+            return stream_to_file(resp, output_path)
 
     raise Exception(f"Issues with download happen. Content: {resp.content}")
@@ -0,0 +1,95 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Bulk status endpoint, queried as GET v1/tasks?ids=<uid>,<uid>,...
+BULK_ENDPOINT = "v1/tasks"
+
+# Failed bulk requests in a row after which a container is queried task by task from then on
+MAX_BULK_FAILURES = 3
+
+# Containers without a working bulk endpoint, queried task by task from then on
+_without_bulk_endpoint = set()
+
+# Failed bulk requests in a row per container
+_bulk_failures = {}
+
+
+def create_session(parallel_requests=8):
+    """
+    Session keeping `parallel_requests` connections alive for repeated requests to the container
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=parallel_requests)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def v1_get_tasks(host, port, uids, scheme="http", session=None, batch_size=200, parallel_requests=8):
+    """
+    Getting information about many uploaded files at once
+
+    Returns a dict from uid to task, or to None if the task could not be fetched.
+    The tasks are requested in batches of `batch_size` uids from the bulk endpoint. If the container
+    does not provide it, each task is requested on its own, `parallel_requests` at a time over
+    keep-alive connections of `session`. A client error of the bulk endpoint turns it off for the container right
+    away, a server error or a response without the requested tasks only after `MAX_BULK_FAILURES` in a row;
+    until then the tasks of the failed batch are requested one by one.
+    """
+    url = f"{scheme}://{host}:{port}"
+    session = session or create_session(parallel_requests)
+    uids = list(uids)
+    tasks = {}
+
+    if url not in _without_bulk_endpoint:
+        for i in range(0, len(uids), batch_size):
+            batch = uids[i:i + batch_size]
+            try:
+                resp = session.get(f"{url}/{BULK_ENDPOINT}", params={"ids": ",".join(batch)})
+                logging.debug("Received response (%s) for \"%s\"", resp.status_code, f"/{BULK_ENDPOINT}")
+                if 400 <= resp.status_code < 500:
+                    logging.info("Container has no bulk status endpoint (%s), requesting tasks one by one",
+                                 resp.status_code)
+                    _without_bulk_endpoint.add(url)
+                    break
+                resp.raise_for_status()
+                content = resp.json()
+                # Either a dict from uid to task or a list of tasks
+                batch_tasks = content if isinstance(content, dict) else {task["id"]: task for task in content}
+                if not any(uid in batch_tasks for uid in batch):
+                    raise ValueError(f"None of the requested tasks in the response: {resp.content[:200]!r}")
+            except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+                logging.error("Issues with getting tasks happen: %s", e)
+                _bulk_failures[url] = _bulk_failures.get(url, 0) + 1
+                if _bulk_failures[url] >= MAX_BULK_FAILURES:
+                    logging.info("Bulk status endpoint failed %s times in a row, requesting tasks one by one",
+                                 _bulk_failures[url])
+                    _without_bulk_endpoint.add(url)
+                break
+            _bulk_failures.pop(url, None)
+            tasks.update(batch_tasks)
+        else:
+            return {uid: tasks.get(uid) for uid in uids}
+
+    def get_task(uid):
+        endpoint = f"v1/task/{uid}"
+        try:
+            resp = session.get(f"{url}/{endpoint}")
+        except requests.RequestException as e:
+            logging.error("Issues with getting task happen: %s", e)
+            return None
+
+        logging.debug("Received response (%s) for \"%s\"", resp.status_code, f"/{endpoint}")
+        if 200 <= resp.status_code < 400:
+            return resp.json()
+
+        logging.error("Issues with getting task happen. Content: %s", resp.content)
+        return None
+
+    remaining = [uid for uid in uids if uid not in tasks]
+    with ThreadPoolExecutor(max_workers=parallel_requests) as executor:
+        tasks.update(zip(remaining, executor.map(get_task, remaining)))
+    return {uid: tasks.get(uid) for uid in uids}
@@ -1,33 +1,81 @@
 import logging
+import os
+import uuid
 from os.path import basename
 from time import sleep
 
 import requests
 
 
+class MultipartFileBody:
+    """
+    multipart/form-data request body which streams the file from disk in chunks
+
+    requests would otherwise load the whole file into memory to encode the form.
+    """
+
+    def __init__(self, field_name, file_path, file_mime):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        head = (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{field_name}\"; filename=\"{basename(file_path)}\"\r\n"
+            f"Content-Type: {file_mime}\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.size = len(head) + os.path.getsize(file_path) + len(tail)
+        self.file = open(file_path, "rb")
+        self.parts = [head, self.file, tail]
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        chunk = b""
+        while self.parts and (size < 0 or len(chunk) < size):
+            part = self.parts[0]
+            if isinstance(part, bytes):
+                n = len(part) if size < 0 else size - len(chunk)
+                chunk += part[:n]
+                if n < len(part):
+                    self.parts[0] = part[n:]
+                else:
+                    self.parts.pop(0)
+            else:
+                data = part.read(-1 if size < 0 else size - len(chunk))
+                if data:
+                    chunk += data
+                else:
+                    self.parts.pop(0)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def v1_upload_async(host, port, file_path, params, file_mime, scheme="http"):
     """
     Asynchronously upload file
 
-    Can be used for both images and videos
+    Can be used for both images and videos. The file is streamed from disk,
+    so memory usage does not grow with the file size.
     """
     url = f"{scheme}://{host}:{port}"
     endpoint = "v1/file"
 
-    file_name = basename(file_path)
-    with open(file_path, "rb") as fd:
-        file_blob = fd.read()
-
-    upload = {
-        "fileobject": (file_name, file_blob, file_mime)
-    }
-
-    resp = requests.post(
-        f"{url}/{endpoint}",
-        params=params,
-        files=upload,
-        headers={"x-is-async": "1"}
-    )
+    with MultipartFileBody("fileobject", file_path, file_mime) as upload:
+        resp = requests.post(
+            f"{url}/{endpoint}",
+            params=params,
+            data=upload,
+            headers={"x-is-async": "1", "Content-Type": upload.content_type}
+        )
 
     logging.debug("Received response (%s) for \"%s\"", resp.status_code, f"/{endpoint}")
     if 200 <= resp.status_code < 400:
@@ -0,0 +1,116 @@
+import unittest
+import os
+import argparse
+import importlib
+import socket
+import sys
+import tempfile
+import threading
+from unittest.mock import patch
+
+# The client parses its arguments on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+with patch.object(sys, 'argv', ['celantur-jpeg-client.py', '-i', '.', '-o', '.']):
+    jpeg_client = importlib.import_module('celantur-jpeg-client')
+
+
+class JpegServer:
+    """
+    Loopback server of the JPEG protocol answering each file with its bytes reversed, or with nothing if `fail`
+    """
+
+    def __init__(self, fail: bool = False):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.fail = fail
+        self.received = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection: socket.socket):
+        with connection:
+            data = bytearray()
+            while chunk := connection.recv(65536):
+                data += chunk
+            self.received.append(bytes(data))
+            if not self.fail:
+                connection.sendall(data[::-1])
+
+    def close(self):
+        self.server.close()
+
+
+class TestJpegClient(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.input = os.path.join(self.folder.name, 'input')
+        self.output = os.path.join(self.folder.name, 'output')
+        self.server = JpegServer()
+        self.addCleanup(self.server.close)
+
+    def write_files(self, files: dict):
+        for path, data in files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.input, path)), exist_ok=True)
+            with open(os.path.join(self.input, path), 'wb') as f:
+                f.write(data)
+
+    def output_files(self) -> dict:
+        files = {}
+        for root, _, file_names in os.walk(self.output):
+            for file_name in file_names:
+                with open(os.path.join(root, file_name), 'rb') as f:
+                    files[os.path.relpath(os.path.join(root, file_name), self.output)] = f.read()
+        return files
+
+    def process_files(self, **options):
+        arguments = argparse.Namespace(**{
+            **vars(jpeg_client.args), 'input': self.input, 'output': self.output, 'host': '127.0.0.1',
+            'port': self.server.port, 'connections': 2, 'chunk_size': 16, **options})
+        with patch.object(jpeg_client, 'args', arguments):
+            jpeg_client.process_files()
+
+    def test_process_files(self):
+        files = {'a.jpg': os.urandom(100), os.path.join('sub', 'b.JPEG'): os.urandom(50)}
+        self.write_files({**files, 'c.png': b'png'})
+        self.process_files()
+        self.assertDictEqual({path: data[::-1] for path, data in files.items()}, self.output_files())
+
+        for path in files:
+            os.remove(os.path.join(self.output, path))
+        self.process_files(recursive=False)
+        self.assertDictEqual({'a.jpg': files['a.jpg'][::-1]}, self.output_files())
+
+    def test_skip_existing_outputs(self):
+        files = {'a.jpg': b'first', 'b.jpg': b'second'}
+        self.write_files(files)
+        os.makedirs(self.output)
+        with open(os.path.join(self.output, 'a.jpg'), 'wb') as f:
+            f.write(b'existing')
+
+        self.process_files()
+        self.assertListEqual([b'second'], self.server.received)
+        self.assertEqual(b'existing', self.output_files()['a.jpg'])
+
+        self.process_files(overwrite=True)
+        self.assertDictEqual({path: data[::-1] for path, data in files.items()}, self.output_files())
+
+    def test_failed_files(self):
+        self.write_files({'a.jpg': b'first', 'b.jpg': b'second'})
+        self.server.fail = True
+        with self.assertRaises(SystemExit) as exited:
+            self.process_files()
+        self.assertTrue(exited.exception.code.startswith('Failed to process 2 images'))
+        # Neither a partial output nor an output that would be skipped on the next run
+        self.assertDictEqual({}, self.output_files())
+
+
+if __name__ == '__main__':
+    unittest.main()
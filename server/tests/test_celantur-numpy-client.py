@@ -0,0 +1,190 @@
+import unittest
+import os
+import argparse
+import importlib
+import socket
+import sys
+import tempfile
+import threading
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+
+# The client parses its arguments on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+with patch.object(sys, 'argv', ['celantur-numpy-client.py', '-i', '.', '-o', '.']):
+    numpy_client = importlib.import_module('celantur-numpy-client')
+
+
+class FramedEchoServer:
+    """
+    Loopback server of the framed protocol answering each frame with its payload.
+
+    The responses of `batch` frames are sent together in reverse order, the first `drop_connections`
+    connections are closed after their first frame without an answer.
+    """
+
+    def __init__(self, batch: int = 1, drop_connections: int = 0):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.batch = batch
+        self.drop_connections = drop_connections
+        self.connections = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            drop = self.connections <= self.drop_connections
+            threading.Thread(target=self.handle, args=(connection, drop), daemon=True).start()
+
+    def handle(self, connection: socket.socket, drop: bool):
+        frames = []
+        with connection:
+            while True:
+                header = memoryview(bytearray(numpy_client.FRAME_HEADER.size))
+                if numpy_client.recv_into_buffer(connection, header) < len(header):
+                    return
+                size, request_id = numpy_client.FRAME_HEADER.unpack(header)
+                payload = memoryview(bytearray(size))
+                numpy_client.recv_into_buffer(connection, payload)
+                if drop:
+                    return
+                frames.append((request_id, payload))
+                if len(frames) == self.batch:
+                    for request_id, payload in reversed(frames):
+                        numpy_client.send_buffers(connection, [
+                            numpy_client.FRAME_HEADER.pack(len(payload), request_id), payload])
+                    frames.clear()
+
+    def close(self):
+        self.server.close()
+
+
+def images(n: int) -> list:
+    return [np.full((2 + i, 3, 3), i, dtype=np.uint8) for i in range(n)]
+
+
+class TestFramedClient(unittest.TestCase):
+    def start_server(self, **kwargs) -> FramedEchoServer:
+        server = FramedEchoServer(**kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def start_client(self, server: FramedEchoServer, **kwargs) -> 'numpy_client.FramedClient':
+        client = numpy_client.FramedClient('127.0.0.1', server.port, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_framing(self):
+        server = self.start_server()
+        for payload_format in ['npy', 'raw']:
+            client = self.start_client(server, connections=2, in_flight=2, payload_format=payload_format)
+            for image in images(5):
+                response = client.submit(image).result(timeout=5)
+                np.testing.assert_array_equal(client.decode(response), image)
+
+    def test_out_of_order_responses(self):
+        server = self.start_server(batch=4)
+        client = self.start_client(server, connections=1, in_flight=4)
+        sent = images(4)
+        responses = [client.submit(image) for image in sent]
+        for image, response in zip(sent, responses):
+            np.testing.assert_array_equal(client.decode(response.result(timeout=5)), image)
+
+    def test_resend_after_connection_loss(self):
+        server = self.start_server(drop_connections=1)
+        client = self.start_client(server, connections=1, in_flight=2, retries=2)
+        sent = images(3)
+        responses = [client.submit(image) for image in sent]
+        for image, response in zip(sent, responses):
+            np.testing.assert_array_equal(client.decode(response.result(timeout=5)), image)
+        self.assertEqual(server.connections, 2)
+
+    def test_fail_after_connection_loss(self):
+        server = self.start_server(drop_connections=100)
+        client = self.start_client(server, connections=1, in_flight=2, retries=1)
+        # More images than slots: the third one waits for a slot of the failed requests
+        responses = [client.submit(image) for image in images(3)]
+        for response in responses:
+            self.assertIsInstance(response.exception(timeout=5), ConnectionError)
+
+        connection = numpy_client.FramedConnection('127.0.0.1', server.port, in_flight=1)
+        self.addCleanup(connection.close)
+        with self.assertRaises(ConnectionError):
+            connection.submit(0, [b'payload']).result(timeout=5)
+        with self.assertRaises(numpy_client.ConnectionClosedError):
+            connection.submit(1, [b'payload'])
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.input = os.path.join(self.folder.name, 'input')
+        self.output = os.path.join(self.folder.name, 'output')
+        os.makedirs(self.input)
+        os.makedirs(self.output)
+        self.server = FramedEchoServer()
+        self.addCleanup(self.server.close)
+
+    def write_images(self, n: int) -> dict:
+        images = {f'{i}.png': np.random.randint(0, 256, (4 + i, 5, 3), dtype=np.uint8) for i in range(n)}
+        for filename, image in images.items():
+            cv2.imwrite(os.path.join(self.input, filename), image)
+        return images
+
+    def run_pipeline(self, **options) -> SystemExit:
+        """
+        Run the pipeline over the framed protocol, returns how it exited if it failed
+        """
+        arguments = argparse.Namespace(**{
+            **vars(numpy_client.args), 'input': self.input, 'output': self.output, 'host': '127.0.0.1',
+            'port': self.server.port, 'protocol': 'framed', 'connections': 2, 'in_flight': 2, 'retries': 0,
+            'decode_workers': 2, 'workers': 2, 'encode_workers': 2, 'queue_depth': 2, **options})
+        exited = []
+
+        def run():
+            try:
+                numpy_client.process_images_pipelined()
+            except SystemExit as e:
+                exited.append(e)
+
+        with patch.object(numpy_client, 'args', arguments):
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(timeout=10)
+        # All steps stopped at their end marker
+        self.assertFalse(thread.is_alive(), 'The pipeline did not shut down')
+        return exited[0] if exited else None
+
+    def test_process_images(self):
+        images = self.write_images(6)
+        for payload_format in ['npy', 'raw']:
+            self.assertIsNone(self.run_pipeline(format=payload_format))
+            for filename, image in images.items():
+                np.testing.assert_array_equal(cv2.imread(os.path.join(self.output, filename)), image)
+
+    def test_collect_failures(self):
+        images = self.write_images(3)
+        with open(os.path.join(self.input, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+
+        # A failed image does not stop the others
+        exited = self.run_pipeline()
+        self.assertEqual('Failed to process 1 images: broken.png', exited.code)
+        self.assertListEqual(sorted(images), sorted(os.listdir(self.output)))
+
+        # Nor does a lost connection stop the pipeline
+        self.server.drop_connections = 100
+        exited = self.run_pipeline(queue_depth=1)
+        self.assertTrue(exited.code.startswith('Failed to process 4 images'))
+
+
+if __name__ == '__main__':
+    unittest.main()
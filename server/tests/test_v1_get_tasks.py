@@ -0,0 +1,102 @@
+import unittest
+import os
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snippets import v1_get_tasks
+
+
+class StatusServer:
+    """
+    Container stub answering the bulk status endpoint with `bulk_status` and `bulk_body`,
+    and each task on its own as processing
+    """
+
+    def __init__(self, bulk_status: int = 200, bulk_body=None):
+        self.bulk_status = bulk_status
+        self.bulk_body = bulk_body
+        self.bulk_requests = 0
+        self.task_requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send(self, status: int, body):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith(f'/{v1_get_tasks.BULK_ENDPOINT}?'):
+                    stub.bulk_requests += 1
+                    uids = self.path.split('ids=', 1)[1].split('%2C')
+                    body = stub.bulk_body if stub.bulk_body is not None else [{'id': uid, 'status': 'done'} for uid in uids]
+                    return self.send(stub.bulk_status, body)
+                stub.task_requests += 1
+                self.send(200, {'id': self.path.rsplit('/', 1)[1], 'status': 'processing'})
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestGetTasks(unittest.TestCase):
+    uids = ['a', 'b']
+
+    def start_server(self, **kwargs) -> StatusServer:
+        server = StatusServer(**kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def statuses(self, server: StatusServer) -> dict:
+        tasks = v1_get_tasks.v1_get_tasks('127.0.0.1', server.port, self.uids)
+        return {uid: task['status'] for uid, task in tasks.items()}
+
+    def test_bulk_endpoint(self):
+        server = self.start_server()
+        for _ in range(2):
+            self.assertDictEqual({'a': 'done', 'b': 'done'}, self.statuses(server))
+        self.assertEqual((2, 0), (server.bulk_requests, server.task_requests))
+
+    def test_client_error(self):
+        server = self.start_server(bulk_status=400, bulk_body={'detail': 'Bad Request'})
+        for _ in range(2):
+            self.assertDictEqual({'a': 'processing', 'b': 'processing'}, self.statuses(server))
+        # Turned off right away
+        self.assertEqual((1, 4), (server.bulk_requests, server.task_requests))
+
+    def test_server_error(self):
+        server = self.start_server(bulk_status=500, bulk_body={'detail': 'Internal Server Error'})
+        for _ in range(v1_get_tasks.MAX_BULK_FAILURES + 1):
+            self.assertDictEqual({'a': 'processing', 'b': 'processing'}, self.statuses(server))
+        # Tried again until it failed MAX_BULK_FAILURES times in a row
+        self.assertEqual(v1_get_tasks.MAX_BULK_FAILURES, server.bulk_requests)
+
+    def test_malformed_response(self):
+        for body in [b'<html></html>', {'tasks': [{'id': 'a', 'status': 'done'}]}, [{'status': 'done'}]]:
+            server = self.start_server(bulk_body=body)
+            for _ in range(v1_get_tasks.MAX_BULK_FAILURES + 1):
+                self.assertDictEqual({'a': 'processing', 'b': 'processing'}, self.statuses(server))
+            self.assertEqual(v1_get_tasks.MAX_BULK_FAILURES, server.bulk_requests)
+
+
+if __name__ == '__main__':
+    unittest.main()